@@ -4,13 +4,14 @@ __describe__ = 'background tasks'
 import asyncio
 import functools
 from multiprocessing import cpu_count
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
 from typing import Callable, Coroutine, Awaitable
 
 import anyio
 
 worker_count: int = max(cpu_count(), 4)
 executor = None
+thread_executor = None
 
 
 def create_process_workers():
@@ -18,6 +19,25 @@ def create_process_workers():
     executor = ProcessPoolExecutor(max_workers=worker_count)
 
 
+def create_thread_workers():
+    global thread_executor
+    thread_executor = ThreadPoolExecutor(max_workers=worker_count)
+
+
+def submit_thread(func, *args, **kwargs) -> Future:
+    """
+    use threads to execute function outside event loop
+
+    :param func: a callable
+    :param args: positional arguments for the callable
+    :param kwargs: keyword arguments for the callable
+    :return: a future that yields the return value of the function.
+    """
+    if not thread_executor:
+        create_thread_workers()
+    return thread_executor.submit(func, *args, **kwargs)
+
+
 def call_subprocess(func, *args, **kwargs) -> Awaitable:
     """
     use multiprocess to execute function for event loop
@@ -0,0 +1,151 @@
+__author__ = 'ziyan.yin'
+__describe__ = 'write-behind buffer'
+
+import asyncio
+import contextvars
+import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, update
+
+from .service import BaseService, BULK_CHUNK_SIZE
+from ..db.session import unit_of_work
+from ..native import _service
+
+
+class WriteBehindBuffer:
+    """
+        collects saves and updates of one model in memory and writes them by chunked bulk statements
+        in one transaction when max_size entries are pending or max_delay seconds have passed,
+        repeated updates of the same id are merged into one row, callers wait until their write
+        is flushed and receive its error if the flush fails
+    """
+
+    def __init__(
+        self,
+        service: BaseService,
+        max_size: int = BULK_CHUNK_SIZE,
+        max_delay: float = 1,
+        capacity: int = BULK_CHUNK_SIZE * 10
+    ):
+        """
+        :param service: service of model
+        :param max_size: pending entries which start a flush
+        :param max_delay: seconds an entry may wait for a flush
+        :param capacity: pending entries which make new writes wait for a flush
+        """
+        self.service = service
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.capacity = capacity
+        self._inserts: Dict[int, Tuple[dict, List[asyncio.Future]]] = {}
+        self._updates: Dict[int, Tuple[dict, List[asyncio.Future]]] = {}
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._drain: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._inserts) + len(self._updates)
+
+    async def save(self, data) -> None:
+        """
+        insert model without create_time, otherwise update its columns except build-in ones
+        """
+        if not data.create_time:
+            data.create_time = datetime.datetime.now()
+            values = {column.name: data.__dict__.get(column.name) for column in self.service.model.__table__.columns}
+            await self._put(data.id, values, True)
+        else:
+            await self.update(data.id, False, **data.__dict__)
+
+    async def update(self, index: int, ignore_none: bool = True, **kwargs) -> None:
+        """
+        update columns of row index, merged with pending updates of the same row
+        """
+        values = _service.update_values(self.service.model.__table__.columns, ignore_none, kwargs)
+        await self._put(index, values, False)
+
+    async def flush(self):
+        await self._spawn()
+
+    async def close(self):
+        """
+        flush everything pending, call it on shutdown
+        """
+        # lock is fair, so this flush runs after those already started
+        await self._spawn()
+
+    async def _put(self, index: int, values: dict, insert: bool):
+        # backpressure: writers share one flush while buffer is full
+        while len(self) >= self.capacity:
+            if self._drain is None or self._drain.done():
+                self._drain = self._spawn()
+            await asyncio.shield(self._drain)
+
+        # buffers are swapped by flush, look them up after waiting
+        pending = self._inserts if insert or index in self._inserts else self._updates
+        future = asyncio.get_running_loop().create_future()
+        if index in pending:
+            pending[index][0].update(values)
+            pending[index][1].append(future)
+        else:
+            pending[index] = (values, [future])
+
+        if len(self) == self.max_size:
+            self._spawn()
+        elif self._handle is None:
+            self._handle = asyncio.get_running_loop().call_later(self.max_delay, self._spawn)
+        await asyncio.shield(future)
+
+    def _spawn(self) -> asyncio.Task:
+        # flush runs in an empty context, never inside the transaction or unit of work of a caller
+        task = contextvars.Context().run(asyncio.ensure_future, self._flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush(self):
+        async with self._lock:
+            if self._handle is not None:
+                self._handle.cancel()
+                self._handle = None
+            inserts, self._inserts = self._inserts, {}
+            updates, self._updates = self._updates, {}
+            if not inserts and not updates:
+                return
+
+            waiters = [future for _, futures in (*inserts.values(), *updates.values()) for future in futures]
+            try:
+                async with unit_of_work():
+                    if inserts:
+                        await self.service.bulk_insert(*(values for values, _ in inserts.values()))
+                    if updates:
+                        await self._update(updates)
+            except Exception as ex:
+                for future in waiters:
+                    if not future.done():
+                        future.set_exception(ex)
+            else:
+                for future in waiters:
+                    if not future.done():
+                        future.set_result(None)
+            await self.service.invalidate(list(updates))
+
+    async def _update(self, updates: Dict[int, Tuple[dict, List[asyncio.Future]]]):
+        table = self.service.model.__table__
+        groups: Dict[tuple, List[dict]] = {}
+        for index, (values, _) in updates.items():
+            if values:
+                params = {'v_' + key: value for key, value in values.items()}
+                params['v_id'] = index
+                groups.setdefault(tuple(sorted(values)), []).append(params)
+
+        current_time = datetime.datetime.now()
+        for columns, rows in groups.items():
+            values = {column: bindparam('v_' + column) for column in columns}
+            values['version'] = table.c.version + 1
+            values['modify_time'] = current_time
+            statement = update(table).where(table.c.id == bindparam('v_id'), table.c.deleted == 0).values(values)
+            for i in range(0, len(rows), BULK_CHUNK_SIZE):
+                await self.service.execute(statement, rows[i:i + BULK_CHUNK_SIZE])
@@ -0,0 +1,295 @@
+__author__ = 'ziyan.yin'
+__describe__ = 'in-process cache'
+
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict, namedtuple
+from typing import Any, Hashable, Iterable, Dict, Set, Tuple
+
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.sql.util import find_tables
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+EntityInfo = namedtuple('EntityInfo', ['hits', 'misses', 'hit_rate'])
+MISSING = object()
+ANY_TABLE = '*'
+
+_registry: 'weakref.WeakSet[TTLCache]' = weakref.WeakSet()
+# count of invalidations per table, ANY_TABLE counts writes to unknown tables
+_generations: Dict[str, int] = {}
+_writes = 0
+
+
+class TTLCache:
+    """
+        lru with per entry ttl, entries can be tagged by table name and evicted by `invalidate`
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._tags: Dict[str, Set[Hashable]] = {}
+        self._lock = threading.Lock()
+        _registry.add(self)
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires, _ = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[str] = (), ttl: float = None, since: tuple = None):
+        """
+        :param since: `generation` of tags read before value was loaded, value is dropped if tags were
+            invalidated meanwhile
+        """
+        tags = tuple(tags)
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if since is not None and since != generation(tags):
+                return
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def invalidate(self, *tags: str) -> int:
+        count = 0
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    if key in self._data:
+                        self._remove(key)
+                        count += 1
+        return count
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+    def _remove(self, key: Hashable):
+        _, _, tags = self._data.pop(key)
+        for tag in tags:
+            if (keys := self._tags.get(tag)) is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResultCache(TTLCache):
+    """
+        TTLCache of FrozenResult with a memory budget, least recently used results are evicted
+        when the estimated size of all rows exceeds max_bytes
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60, max_bytes: int = 64 << 20):
+        super().__init__(maxsize, ttl)
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._sizes: Dict[Hashable, int] = {}
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[str] = (), ttl: float = None, since: tuple = None):
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        super().set(key, value, tags, ttl, since)
+        with self._lock:
+            if key in self._data:
+                self._sizes[key] = size
+                self.bytes += size
+            while self.bytes > self.max_bytes and self._data:
+                self._remove(next(iter(self._data)))
+
+    def clear(self):
+        super().clear()
+        with self._lock:
+            self._sizes.clear()
+            self.bytes = 0
+
+    def _remove(self, key: Hashable):
+        super()._remove(key)
+        self.bytes -= self._sizes.pop(key, 0)
+
+
+class CacheBackend:
+    """
+        storage of EntityCache, implement it to keep entities in an external cache
+    """
+
+    async def get(self, key: str) -> Any:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: dict, ttl: float):
+        raise NotImplementedError
+
+    async def delete(self, *keys: str):
+        raise NotImplementedError
+
+
+class LocalCacheBackend(CacheBackend):
+
+    def __init__(self, maxsize: int = 10000):
+        self.cache = TTLCache(maxsize)
+
+    async def get(self, key: str) -> Any:
+        return self.cache.get(key, None)
+
+    async def set(self, key: str, value: dict, ttl: float):
+        self.cache.set(key, value, ttl=ttl)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self.cache.delete(key)
+
+
+class EntityCache:
+    """
+        read-through cache of models by primary key, entries are column values and every hit
+        returns a new detached instance, so callers never share a mutable object
+    """
+
+    def __init__(self, backend: CacheBackend = None, ttl: float = 60):
+        self.backend = backend or LocalCacheBackend()
+        self.ttl = ttl
+        self._stats: Dict[str, list] = {}
+        self._generations: Dict[str, int] = {}
+
+    async def get(self, model: type, index: int) -> Any:
+        values = await self.backend.get(self._key(model, index))
+        stats = self._stats.setdefault(model.__tablename__, [0, 0])
+        if values is None:
+            stats[1] += 1
+            return None
+        stats[0] += 1
+        return detached(model, values)
+
+    async def put(self, model: type, data: Any, since: tuple = None):
+        """
+        :param since: `generation` of model table read before data was loaded, data is not cached
+            if the table was invalidated meanwhile
+        """
+        if since is not None and since != generation((model.__tablename__,)):
+            return
+        values = column_values(data)
+        await self.backend.set(self._key(model, values['id']), values, self.ttl)
+
+    async def evict(self, model: type, *ids: int):
+        if ids:
+            await self.backend.delete(*(self._key(model, index) for index in ids))
+
+    def evict_all(self, model: type):
+        """
+        drop every entry of model in this process by moving to new keys, old ones expire by ttl
+        """
+        self._generations[model.__tablename__] = self._generations.get(model.__tablename__, 0) + 1
+
+    def info(self, model: type) -> EntityInfo:
+        hits, misses = self._stats.get(model.__tablename__, (0, 0))
+        return EntityInfo(hits, misses, hits / (hits + misses) if hits + misses else 0.0)
+
+    def _key(self, model: type, index: int) -> str:
+        return '%s:%s:%d:%d' % (
+            model.__bind_key__, model.__tablename__, self._generations.get(model.__tablename__, 0), index
+        )
+
+
+def invalidate(*tables: str):
+    """
+    evict entries tagged with any of tables, or with unknown tables, from every cache,
+    ANY_TABLE as a table of unknown writes evicts everything
+    """
+    global _writes
+    _writes += 1
+    for table in tables:
+        _generations[table] = _generations.get(table, 0) + 1
+    for cache in list(_registry):
+        if ANY_TABLE in tables:
+            cache.clear()
+        else:
+            cache.invalidate(ANY_TABLE, *tables)
+
+
+def generation(tags: Iterable[str]) -> tuple:
+    """
+    invalidation counters of tags, read before loading a value and compared when it is cached
+    so a value read before a write is not cached after the write invalidated its tags
+    """
+    if ANY_TABLE in tags:
+        return _writes,
+    return (_generations.get(ANY_TABLE, 0), *(_generations.get(tag, 0) for tag in tags))
+
+
+def column_values(data: Any) -> dict:
+    return {column.name: data.__dict__.get(column.name) for column in data.__table__.columns}
+
+
+def detached(model: type, values: dict) -> Any:
+    """
+    new detached instance of model from column values, never shared with other callers
+    """
+    data = model(**values)
+    make_transient_to_detached(data)
+    return data
+
+
+def _sizeof(frozen) -> int:
+    size = sys.getsizeof(frozen.data)
+    for row in frozen.data:
+        size += sys.getsizeof(row)
+        for value in (row if isinstance(row, (tuple, list)) or hasattr(row, '_fields') else (row,)):
+            size += _sizeof_value(value)
+    return size
+
+
+def _sizeof_value(value) -> int:
+    # getsizeof of a model ignores its __dict__, count its column values instead
+    if hasattr(value, '__table__'):
+        return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in column_values(value).values())
+    return sys.getsizeof(value)
+
+
+def statement_key(statement, params=None, datasource: str = 'default') -> tuple:
+    """
+    key of a statement by its compiled sql and bound parameters
+    """
+    compiled = statement.compile()
+    bound = dict(compiled.params)
+    if params:
+        bound.update(params)
+    return datasource, str(compiled), repr(sorted(bound.items()))
+
+
+def statement_tables(statement) -> Tuple[str, ...]:
+    """
+    names of tables a statement reads, ANY_TABLE if they are unknown e.g. for text
+    """
+    if tables := {table.name for table in find_tables(statement, include_crud=True)}:
+        return tuple(tables)
+    return ANY_TABLE,
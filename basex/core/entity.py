@@ -36,6 +36,8 @@ class Page(BaseEntity, GenericModel, Generic[Model]):
     pages: int = 0
     total: int = 0
     size: int = 0
+    cursor: Optional[str] = None
+    next_cursor: Optional[str] = None
 
     @property
     def model(self):
@@ -0,0 +1,126 @@
+__author__ = 'ziyan.yin'
+__describe__ = 'keyset pagination'
+
+import binascii
+import datetime
+import decimal
+import enum
+from typing import Any, List, Tuple, Callable
+
+import orjson
+from sqlalchemy import and_, or_, tuple_, false
+from sqlalchemy.sql import Select
+
+from .entity import Page, BusinessError
+from .enums import ResultEnum
+from ..common import cryptutils
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """
+    opaque continuation token of the order-by values of last row
+    """
+    return cryptutils.urlsafe_b64encode(orjson.dumps(values, default=str)).decode().rstrip('=')
+
+
+def decode_cursor(token: str, columns: List[Any]) -> List[Any]:
+    try:
+        values = orjson.loads(cryptutils.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError(token)
+        return [_parse(column, value) for column, value in zip(columns, values)]
+    except (ValueError, TypeError, binascii.Error, decimal.InvalidOperation):
+        raise BusinessError(ResultEnum.A0421, message='invalid page cursor')
+
+
+def seek(page: Page, statement: Select, columns: Any) -> Tuple[Select, List[str]]:
+    """
+    order statement by page.orders then id, and start it after page.cursor,
+    NULL of a nullable column sorts after every value (last ascending, first descending)
+
+    :param page: page with cursor, '' for first page
+    :param statement: select
+    :param columns: model or exported columns to look up order columns
+    :return: statement limited to page.size + 1 rows, names of the key columns
+    """
+    orders = [(order.column, order.asc) for order in page.orders if order.column != 'id']
+    orders.append(('id', orders[-1][1] if orders else True))
+    names = [name for name, _ in orders]
+    key_columns = [getattr(columns, name) for name in names]
+
+    clauses = []
+    for column, (_, asc) in zip(key_columns, orders):
+        if _nullable(column):
+            # portable NULLS LAST / NULLS FIRST, which MySQL can not spell
+            clauses.append(column.is_(None) if asc else column.is_(None).desc())
+        clauses.append(column if asc else column.desc())
+    statement = statement.order_by(None).order_by(*clauses)
+    if page.cursor:
+        last = decode_cursor(page.cursor, key_columns)
+        statement = statement.where(_after(key_columns, [asc for _, asc in orders], last))
+    return statement.limit(page.size + 1), names
+
+
+def finish(page: Page, records: list, names: List[str], getter: Callable[[Any, str], Any]) -> Page:
+    """
+    keep page.size records and set page.next_cursor if there are more
+    """
+    if len(records) > page.size:
+        records = records[:page.size]
+        page.next_cursor = encode_cursor([getter(records[-1], name) for name in names])
+    else:
+        page.next_cursor = None
+    page.records = records
+    return page
+
+
+def _after(columns: list, directions: List[bool], values: List[Any]):
+    if not any(_nullable(column) for column in columns):
+        if all(directions):
+            return tuple_(*columns) > tuple_(*values)
+        if not any(directions):
+            return tuple_(*columns) < tuple_(*values)
+    # mixed directions or NULLs: (a > x) or (a = x and b < y) or ...
+    clauses = []
+    for i, (column, asc, value) in enumerate(zip(columns, directions, values)):
+        equals = [_equal(columns[j], values[j]) for j in range(i)]
+        equals.append(_beyond(column, asc, value))
+        clauses.append(and_(*equals))
+    return or_(*clauses)
+
+
+def _nullable(column) -> bool:
+    return getattr(column, 'nullable', True)
+
+
+def _equal(column, value):
+    return column.is_(None) if value is None else column == value
+
+
+def _beyond(column, asc: bool, value):
+    # NULL sorts after every value, so it follows a value ascending and precedes it descending
+    if value is None:
+        return false() if asc else column.is_not(None)
+    if asc:
+        return or_(column > value, column.is_(None)) if _nullable(column) else column > value
+    return column < value
+
+
+def _parse(column, value):
+    if value is None:
+        return None
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type is datetime.datetime:
+        return datetime.datetime.fromisoformat(value)
+    if python_type is datetime.date:
+        return datetime.date.fromisoformat(value)
+    if python_type is decimal.Decimal:
+        return decimal.Decimal(value)
+    if isinstance(python_type, type) and issubclass(python_type, enum.Enum):
+        return python_type(value)
+    if python_type in (int, str) and not isinstance(value, python_type):
+        raise ValueError(value)
+    return value
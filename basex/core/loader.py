@@ -0,0 +1,65 @@
+__author__ = 'ziyan.yin'
+__describe__ = 'batch loader'
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+
+
+class BatchLoader:
+    """
+        collects keys requested in the same loop tick (or within window seconds) and loads them
+        by one call of load_many, callers asking for the same key share one result
+    """
+
+    def __init__(
+        self,
+        load_many: Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]],
+        window: float = 0,
+        max_batch: int = 1000
+    ):
+        self.window = window
+        self.max_batch = max_batch
+        self._load_many = load_many
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self._handle: Optional[asyncio.Handle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def load(self, key: Hashable) -> Any:
+        """
+        :param key: key
+        :return: value of key, None if load_many does not return it
+        """
+        loop = asyncio.get_running_loop()
+        if (future := self._pending.get(key)) is None:
+            future = loop.create_future()
+            self._pending[key] = future
+            if len(self._pending) >= self.max_batch:
+                self._dispatch()
+            elif self._handle is None:
+                if self.window > 0:
+                    self._handle = loop.call_later(self.window, self._dispatch)
+                else:
+                    self._handle = loop.call_soon(self._dispatch)
+        # a cancelled caller must not cancel the load shared with others
+        return await asyncio.shield(future)
+
+    def _dispatch(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        batch, self._pending = self._pending, {}
+        task = asyncio.ensure_future(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: Dict[Hashable, asyncio.Future]):
+        try:
+            values = await self._load_many(list(batch))
+        except Exception as ex:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(ex)
+        else:
+            for key, future in batch.items():
+                if not future.done():
+                    future.set_result(values.get(key))
@@ -7,6 +7,7 @@ from sqlalchemy import func
 from sqlalchemy.sql import Select
 from sqlalchemy.sql.elements import TextClause
 
+from ..core import keyset
 from ..core.entity import Page, DataTableEntity
 from ..core.service import SessionService
 from ..db.mapper import SqlModel
@@ -32,7 +33,7 @@ class DataFrameService(SessionService):
 class DataTableService(SessionService):
 
     async def parse_sql(self, sql: TextClause, **kwargs) -> DataTableEntity:
-        result = await self.execute(sql, **kwargs)
+        result = await self.execute(sql, kwargs)
         columns = list(result.keys())
         if rows := result.all():
             return DataTableEntity(
@@ -73,7 +74,11 @@ class DataTableService(SessionService):
 
 class PageFilterService(SessionService):
 
-    async def paginate(self, page: Page, statement: Select) -> Page:
+    async def paginate(self, page: Page, statement: Select, search_count: bool = False) -> Page:
+        """
+        page by limit/offset, or by keyset when page.cursor is not None ('' for first page)
+        which costs the same for every page and only counts rows if search_count
+        """
         page.current = page.current if page.current > 1 else 1
         page.size = page.size if 1 < page.size < 65536 else 10
         page.orders = page.orders or []
@@ -82,6 +87,20 @@ class PageFilterService(SessionService):
         stmt_order = statement
         page.records = []
 
+        if page.cursor is not None:
+            if search_count:
+                page.total = (await self.scalars(
+                    count_stmt.where(count_stmt.exported_columns['deleted'] == 0)
+                )).first()
+                page.pages = (page.total - 1) // page.size + 1
+            stmt, names = keyset.seek(
+                page, statement.where(statement.exported_columns["deleted"] == 0), statement.exported_columns
+            )
+            rows = [data async for data in self.stream_mappings(stmt)]
+            keyset.finish(page, rows, names, lambda row, name: row[name])
+            page.records = [page.model.parse_obj(data) for data in page.records]
+            return page
+
         res = await self.scalars(
             count_stmt.where(count_stmt.exported_columns['deleted'] == 0)
         )
@@ -1,25 +1,45 @@
 __author__ = 'ziyan.yin'
 __describe__ = 'base service'
 
+import asyncio
 import datetime
 import functools
-from typing import TypeVar, Generic, Optional, List, Callable, Any, Awaitable, AsyncGenerator
-
-from sqlalchemy import func
-from sqlalchemy.engine import Result, ScalarResult
+from typing import (
+    TypeVar, Generic, Optional, List, Callable, Any, Awaitable, AsyncGenerator, Union, Iterable, Dict, Tuple
+)
+
+import orjson
+from loguru import logger
+from sqlalchemy import func, text, update, delete
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.engine import Result, ScalarResult, FrozenResult
+from sqlalchemy.engine.result import SimpleResultMetaData
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.sql import Select, Selectable
+from sqlalchemy.sql import Select, Selectable, ClauseElement, Update, operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, TextClause
 
+from . import cache, keyset
 from .entity import Page
+from .loader import BatchLoader
 from ..db.mapper import SqlModel
+from ..db.session import after_commit, bound_session, get_dialect, is_read, wrote_recently
 from ..native import _service, _session
 
 Model = TypeVar('Model', bound=SqlModel)
+BULK_CHUNK_SIZE = 1000
+# textual statements starting with these do not write
+_READ_SQL = ('select', 'explain', 'show')
+default_count_cache = cache.TTLCache(maxsize=4096, ttl=60)
+_in_flight: Dict[tuple, asyncio.Future] = {}
 
 
 class SessionService:
     __slots__ = ()
+    # opt in to cache results of reads outside transactions, evicted by writes of their tables
+    result_cache: Optional[cache.ResultCache] = None
+    # opt in to let identical reads outside transactions share one execution while it runs
+    single_flight: bool = False
 
     async def _execute_wrapper(self, method: Callable[[AsyncSession], Awaitable[Any]]) -> Any:
         return await _session.execute_wrapper(method, self.datasource)
@@ -29,15 +49,70 @@ class SessionService:
 
     async def execute(self, statement, params=None, **kwargs) -> Result:
         statement = self.statement_intercept(statement)
-        return await self._execute_wrapper(lambda x: x.execute(statement, params, **kwargs))
+        if (frozen := await self._shared(statement, params, kwargs)) is not None:
+            return frozen()
+        res = await self._execute_wrapper(lambda x: x.execute(statement, params, **kwargs))
+        self._written(statement)
+        return res
 
     async def scalar(self, statement, params=None, **kwargs) -> Any:
         statement = self.statement_intercept(statement)
-        return await self._execute_wrapper(lambda x: x.scalar(statement, params, **kwargs))
+        if (frozen := await self._shared(statement, params, kwargs)) is not None:
+            return frozen().scalar()
+        res = await self._execute_wrapper(lambda x: x.scalar(statement, params, **kwargs))
+        self._written(statement)
+        return res
 
     async def scalars(self, statement, params=None, **kwargs) -> ScalarResult:
         statement = self.statement_intercept(statement)
-        return await self._execute_wrapper(lambda x: x.scalars(statement, params, **kwargs))
+        if (frozen := await self._shared(statement, params, kwargs)) is not None:
+            return frozen().scalars()
+        res = await self._execute_wrapper(lambda x: x.scalars(statement, params, **kwargs))
+        self._written(statement)
+        return res
+
+    def _written(self, statement):
+        # evict cached reads of tables the statement wrote, all of them for textual writes
+        if getattr(statement, 'is_dml', False):
+            tables = statement.table.name,
+        elif isinstance(statement, TextClause) and not statement.text.lstrip().lower().startswith(_READ_SQL):
+            tables = cache.ANY_TABLE,
+        else:
+            return
+        if not after_commit(self.datasource, functools.partial(cache.invalidate, *tables)):
+            cache.invalidate(*tables)
+
+    async def _shared(self, statement, params, kwargs: dict) -> Optional[FrozenResult]:
+        """
+        frozen result of a read shared through result_cache or with identical reads in flight,
+        None if statement can not be shared
+        """
+        if self.result_cache is None and not self.single_flight:
+            return None
+        if kwargs or not (params is None or isinstance(params, dict)):
+            return None
+        if not is_read(statement) or bound_session(self.datasource) is not None:
+            return None
+        if wrote_recently(self.datasource):
+            # a context which just wrote reads on its own, cached or in flight reads may predate the write
+            return None
+        key = cache.statement_key(statement, params, self.datasource)
+        if self.result_cache is not None and (frozen := self.result_cache.get(key, None)) is not None:
+            return _detach(frozen)
+
+        async def fetch() -> FrozenResult:
+            tags = cache.statement_tables(statement)
+            since = cache.generation(tags)
+            res, replica = await self._execute_wrapper(lambda x: _read(x, statement, params))
+            # a replica may lag behind writes already invalidated, its rows are not cached
+            if self.result_cache is not None and not replica:
+                self.result_cache.set(key, res, tags=tags, since=since)
+            return res
+
+        # every caller gets its own copies of models, the frozen rows stay shared
+        if self.single_flight:
+            return _detach(await _single_flight(key, fetch))
+        return _detach(await fetch())
 
     def stream(self, statement, params=None, **kwargs) -> AsyncGenerator:
         statement = self.statement_intercept(statement)
@@ -68,6 +143,10 @@ class SessionService:
 
 class BaseService(Generic[Model], SessionService):
     root = None
+    count_cache: cache.TTLCache = default_count_cache
+    # seconds to collect get calls into one query, 0 for one loop tick, None to disable
+    get_batch_window: Optional[float] = None
+    entity_cache: Optional[cache.EntityCache] = None
 
     def __new__(cls, *args, **kwargs):
         if not cls.root:
@@ -78,15 +157,39 @@ class BaseService(Generic[Model], SessionService):
         super().__init__()
 
     async def get(self, index: int, options=None, **kw) -> Optional[Model]:
+        if options is None and not kw and bound_session(self.datasource) is None:
+            if self.entity_cache is not None and not wrote_recently(self.datasource):
+                if (data := await self.entity_cache.get(self.model, index)) is not None:
+                    return data
+                since = cache.generation((self.model.__tablename__,))
+                if (data := await self._get(index)) is not None:
+                    await self.entity_cache.put(self.model, data, since)
+                return data
+            return await self._get(index)
         if data := await self._execute_wrapper(lambda x: x.get(self.model, index, options, **kw)):
             return data
         return None
 
+    async def _get(self, index: int) -> Optional[Model]:
+        if self.get_batch_window is not None:
+            return await self.get_loader.load(index)
+        return await self._execute_wrapper(lambda x: x.get(self.model, index))
+
+    @functools.cached_property
+    def get_loader(self) -> BatchLoader:
+        return BatchLoader(self._get_many, self.get_batch_window, BULK_CHUNK_SIZE)
+
+    async def _get_many(self, ids: List[int]) -> dict:
+        statement = select(self.model).where(self.model.id.in_(ids))
+        res = await self._execute_wrapper(lambda x: x.scalars(statement))
+        return {item.id: item for item in res.all()}
+
     async def save(self, data: Model, ignore_none: bool = True) -> Optional[Model]:
         if data.create_time:
             return await self.update(data, ignore_none=ignore_none, **data.dict())
         data.create_time = datetime.datetime.now()
         await _session.method_wrapper(lambda x: x.add(data), self.datasource)
+        await self.invalidate()
         return data
 
     async def update(self, data: Model, ignore_none: bool = True, **kwargs) -> Model:
@@ -96,7 +199,9 @@ class BaseService(Generic[Model], SessionService):
             x.add(data)
             return data
 
-        return await self._method_wrapper(_execute)
+        res = await self._method_wrapper(_execute)
+        await self.invalidate([data.id])
+        return res
 
     async def delete(self, data: Model, logic_delete: bool = True) -> int:
         if logic_delete:
@@ -107,26 +212,225 @@ class BaseService(Generic[Model], SessionService):
             await self._method_wrapper(_logic_delete)
         else:
             await self._execute_wrapper(lambda x: x.delete(data))
+        await self.invalidate([data.id])
         return 1
 
     async def create_batch(self, *data: Model) -> List[Model]:
         for d in data:
             d.create_time = datetime.datetime.now()
         await self._method_wrapper(lambda x: x.add_all(data))
+        await self.invalidate()
+        return list(data)
+
+    async def bulk_insert(
+        self,
+        *data: Union[Model, dict],
+        chunk_size: int = BULK_CHUNK_SIZE,
+        returning: bool = False
+    ) -> Union[int, List[Model]]:
+        """
+        insert rows by chunked executemany without unit of work, identity map or version bookkeeping,
+        ids which are missing or 0 are reserved from model cursor in bulk
+
+        :param data: models or dicts of column values
+        :param chunk_size: rows per statement
+        :param returning: select inserted rows back as models
+        :return: count of inserted rows, or models if returning
+        """
+        rows = _insert_rows(self.model, data)
+        if missing := [row for row in rows if not row['id']]:
+            for row, index in zip(missing, await self.model.__cursor__.next_batch_async(len(missing))):
+                row['id'] = index
+        table = self.model.__table__
+
+        async def _execute(x: AsyncSession):
+            for i in range(0, len(rows), chunk_size):
+                await x.execute(table.insert(), rows[i:i + chunk_size])
+            if not returning:
+                return len(rows)
+            res = []
+            for i in range(0, len(rows), chunk_size):
+                ids = [row['id'] for row in rows[i:i + chunk_size]]
+                res.extend((await x.scalars(select(self.model).where(self.model.id.in_(ids)))).all())
+            return res
+
+        if not rows:
+            return [] if returning else 0
+        res = await self._execute_wrapper(_execute)
+        await self.invalidate()
+        return res
+
+    async def upsert(self, *data: Union[Model, dict], chunk_size: int = BULK_CHUNK_SIZE) -> int:
+        """
+        insert rows or update them on conflict of id by one statement per chunk,
+        only columns given by a dict (every column of a model) are updated on conflict,
+        version and modify_time are updated too while other build-in columns are kept,
+        supports PostgreSQL, MySQL and SQLite
+
+        :param data: models or dicts of column values
+        :param chunk_size: rows per statement
+        :return: count of rows
+        """
+        if not (rows := _insert_rows(self.model, data)):
+            return 0
+        if missing := [row for row in rows if not row['id']]:
+            for row, index in zip(missing, await self.model.__cursor__.next_batch_async(len(missing))):
+                row['id'] = index
+        table = self.model.__table__
+        dialect = get_dialect(self.datasource).name
+        columns = [column.name for column in table.columns if column.name not in _service.build_in]
+        groups: Dict[tuple, List[dict]] = {}
+        for item, row in zip(data, rows):
+            values = item if isinstance(item, dict) else item.__dict__
+            groups.setdefault(tuple(name for name in columns if name in values), []).append(row)
+
+        async def _execute(x: AsyncSession):
+            for names, group in groups.items():
+                statement = _upsert_statement(table, dialect, names)
+                for i in range(0, len(group), chunk_size):
+                    await x.execute(statement, group[i:i + chunk_size])
+            return len(rows)
+
+        res = await self._execute_wrapper(_execute)
+        await self.invalidate([row['id'] for row in rows])
+        return res
+
+    async def save_batch(
+        self,
+        *data: Model,
+        upsert: bool = False,
+        chunk_size: int = BULK_CHUNK_SIZE
+    ) -> List[Model]:
+        """
+        save models, create those without create_time and update the others,
+        or upsert all of them by id in one statement per chunk when rows may exist already,
+        upserted models are returned as read back from database since their version is unknown
+        """
+        if upsert:
+            if missing := [item for item in data if not item.id]:
+                for item, index in zip(missing, await self.model.__cursor__.next_batch_async(len(missing))):
+                    item.id = index
+            await self.upsert(*data, chunk_size=chunk_size)
+            ids = list(dict.fromkeys(item.id for item in data))
+            saved = {}
+            for i in range(0, len(ids), chunk_size):
+                saved.update(await self._get_many(ids[i:i + chunk_size]))
+            return [saved[item.id] for item in data]
+        created, updated = [], []
+        for item in data:
+            (updated if item.create_time else created).append(item)
+        if created:
+            await self.create_batch(*created)
+        if updated:
+            await self.update_batch(*updated)
         return list(data)
 
     async def update_batch(self, *data: Model, ignore_none: bool = True, **kwargs) -> List[Model]:
         def _execute(x: AsyncSession):
-            _service.update_batch(data, ignore_none, kwargs)
+            _service.update_batch(list(data), ignore_none, kwargs)
             current_time = datetime.datetime.now()
             for item in data:
                 item.modify_time = current_time
             x.add_all(data)
             return data
 
-        return await self._method_wrapper(_execute)
+        res = await self._method_wrapper(_execute)
+        await self.invalidate([item.id for item in data])
+        return res
+
+    async def update_where(
+        self,
+        ids_or_predicate: Union[Iterable[int], ClauseElement],
+        ignore_none: bool = True,
+        chunk_size: int = BULK_CHUNK_SIZE,
+        **kwargs
+    ) -> int:
+        """
+        set kwargs on rows by one UPDATE per chunk of ids instead of loading models,
+        build-in columns are ignored, version and modify_time are updated like an orm update
+
+        :param ids_or_predicate: ids, or where clause of model table
+        :param ignore_none: skip kwargs of None
+        :param chunk_size: ids per statement
+        :return: count of updated rows
+        """
+        table = self.model.__table__
+        if not (values := _service.update_values(table.columns, ignore_none, kwargs)):
+            return 0
+        values['modify_time'] = datetime.datetime.now()
+        values['version'] = table.c.version + 1
+        return await self._execute_where(update(table).values(values), ids_or_predicate, chunk_size)
+
+    async def delete_batch(
+        self,
+        ids: Iterable[int],
+        logic_delete: bool = True,
+        chunk_size: int = BULK_CHUNK_SIZE
+    ) -> int:
+        """
+        delete rows by one statement per chunk of ids
+
+        :param ids: ids
+        :param logic_delete: mark deleted instead of removing rows
+        :param chunk_size: ids per statement
+        :return: count of deleted rows
+        """
+        table = self.model.__table__
+        if logic_delete:
+            statement = update(table).values(
+                deleted=1,
+                modify_time=datetime.datetime.now(),
+                version=table.c.version + 1
+            )
+        else:
+            statement = delete(table)
+        return await self._execute_where(statement, ids, chunk_size)
+
+    async def _execute_where(self, statement, ids_or_predicate, chunk_size: int) -> int:
+        table = self.model.__table__
+        if isinstance(statement, Update):
+            # rows already deleted are left untouched, a hard delete still removes them
+            statement = statement.where(table.c.deleted == 0)
+        statement = statement.execution_options(synchronize_session=False)
+        if isinstance(ids_or_predicate, ClauseElement):
+            ids = None
+            statements = [statement.where(ids_or_predicate)]
+        else:
+            ids = list(dict.fromkeys(ids_or_predicate))
+            statements = [
+                statement.where(table.c.id.in_(ids[i:i + chunk_size])) for i in range(0, len(ids), chunk_size)
+            ]
+        if not statements:
+            return 0
+
+        async def _execute(x: AsyncSession):
+            count = 0
+            for stmt in statements:
+                count += (await x.execute(stmt)).rowcount
+            return count
+
+        res = await self._execute_wrapper(_execute)
+        await self.invalidate(ids)
+        return res
 
-    async def paginate(self, page: Page, statement: Select = None) -> Page:
+    async def paginate(
+        self,
+        page: Page,
+        statement: Select = None,
+        search_count: bool = False,
+        count_mode: str = 'exact'
+    ) -> Page:
+        """
+        page by limit/offset, or by keyset when page.cursor is not None ('' for first page)
+        which costs the same for every page and only counts rows if search_count
+
+        :param page: page
+        :param statement: select of model, select all if None
+        :param search_count: count rows in keyset mode
+        :param count_mode: 'exact', 'cached' to reuse a count until ttl or a write of the model,
+            'estimated' to use planner statistics on PostgreSQL/MySQL
+        :return: page
+        """
         if statement is None:
             statement = self.selectable()
 
@@ -137,29 +441,123 @@ class BaseService(Generic[Model], SessionService):
         page.records = []
 
         count_stmt = statement.with_only_columns(func.count(self.model.id))
-        if count := await self.scalar(count_stmt):
-            _service.paginate(page, self.model, statement, count)
-            stream = self.stream_scalars(statement.limit(page.size).offset((page.current - 1) * page.size))
-            async for data in stream:
-                page.records.append(data)
+        if page.cursor is not None:
+            if search_count:
+                page.total = await self.count(count_stmt, statement, count_mode)
+                page.pages = (page.total - 1) // page.size + 1
+            stmt, names = keyset.seek(page, statement, self.model)
+            return keyset.finish(page, (await self.scalars(stmt)).all(), names, getattr)
+
+        _service.order_by(page, self.model, statement)
+        page_stmt = statement.limit(page.size).offset((page.current - 1) * page.size)
+        if bound_session(self.datasource) is None:
+            # count and page run on their own pooled connections at the same time
+            count, records = await asyncio.gather(
+                self.count(count_stmt, statement, count_mode),
+                self.scalars(page_stmt)
+            )
+        else:
+            count = await self.count(count_stmt, statement, count_mode)
+            records = await self.scalars(page_stmt) if count else None
 
+        if count:
+            _service.paginate(page, self.model, statement, count)
+            page.records = records.all()
         return page
 
+    async def count(self, count_stmt: Select, statement: Select = None, count_mode: str = 'exact') -> int:
+        if count_mode == 'estimated' and statement is not None:
+            if (estimated := await self._estimate(statement)) is not None:
+                return estimated
+        elif count_mode == 'cached' and not wrote_recently(self.datasource):
+            key = cache.statement_key(count_stmt, datasource=self.datasource)
+            if (count := self.count_cache.get(key, None)) is None:
+                tags = cache.statement_tables(count_stmt)
+                since = cache.generation(tags)
+                count = await self.scalar(count_stmt)
+                self.count_cache.set(key, count, tags=tags, since=since)
+            return count
+        return await self.scalar(count_stmt)
+
+    async def _estimate(self, statement: Select) -> Optional[int]:
+        dialect = get_dialect(self.datasource)
+        if dialect.name not in ('postgresql', 'mysql'):
+            return None
+        try:
+            sql = str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+            if dialect.name == 'postgresql':
+                plan = await self.scalar(text('EXPLAIN (FORMAT JSON) ' + sql))
+                if isinstance(plan, (str, bytes)):
+                    plan = orjson.loads(plan)
+                return int(plan[0]['Plan']['Plan Rows'])
+            rows = (await self.execute(text('EXPLAIN ' + sql))).mappings().all()
+            return int(rows[0]['rows'])
+        except Exception as ex:
+            logger.warning('estimated count is not available: %s' % ex)
+            return None
+
     async def find(self, statement: Select = None) -> List[Model]:
         if statement is None:
             statement = self.selectable()
         res = await self.scalars(statement)
         return res.all()
 
-    async def find_one(self, statement: Select = None) -> Optional[Model]:
+    async def find_one(self, statement: Select = None, cached: bool = False) -> Optional[Model]:
+        """
+        :param statement: select of model, select all if None
+        :param cached: look up entity cache when statement only filters model by id
+        :return: model
+        """
         if statement is None:
             statement = self.selectable()
+        if cached and self.entity_cache is not None and (index := _primary_key(self.model, statement)) is not None:
+            if (data := await self.get(index)) is not None and not data.deleted:
+                return data
+            return None
         res = await self.scalar(statement)
         return res
 
+    async def find_between(
+        self,
+        start: Union[datetime.datetime, float],
+        end: Union[datetime.datetime, float],
+        statement: Select = None
+    ) -> List[Model]:
+        """
+        rows created between start and end, filtered by the time embedded in primary key
+        (100ms precision) instead of create_time
+
+        :param start: datetime or unix time
+        :param end: datetime or unix time
+        :param statement: select of model, select all if None
+        :return: models ordered by id
+        """
+        if statement is None:
+            statement = self.selectable()
+        id_min, id_max = self.model.__cursor__.id_range(start, end)
+        return await self.find(statement.where(self.model.id.between(id_min, id_max)).order_by(self.model.id))
+
     def selectable(self) -> Select:
         return select(self.model)
 
+    async def invalidate(self, ids: Optional[Iterable[int]] = ()):
+        """
+        evict cached reads of model table, called by every write of this service,
+        deferred until commit if the write is part of a transaction or unit of work
+
+        :param ids: ids of changed rows to evict from entity cache, None if they are unknown
+        """
+        if not after_commit(self.datasource, functools.partial(self._invalidate, ids)):
+            await self._invalidate(ids)
+
+    async def _invalidate(self, ids: Optional[Iterable[int]]):
+        cache.invalidate(self.model.__tablename__)
+        if self.entity_cache is not None:
+            if ids is None:
+                self.entity_cache.evict_all(self.model)
+            else:
+                await self.entity_cache.evict(self.model, *ids)
+
     @property
     def model(self) -> Model:
         return _model(self.__class__)
@@ -169,6 +567,122 @@ class BaseService(Generic[Model], SessionService):
         return self.model.__bind_key__
 
 
+async def _single_flight(key: tuple, fetch: Callable[[], Awaitable[FrozenResult]]) -> FrozenResult:
+    loop = asyncio.get_running_loop()
+    if (future := _in_flight.get(key)) is None or future.get_loop() is not loop:
+        # a task, so a cancelled caller does not cancel the execution shared with others
+        future = _in_flight[key] = asyncio.ensure_future(fetch())
+        future.add_done_callback(lambda x: _in_flight.pop(key) if _in_flight.get(key) is x else None)
+    return await asyncio.shield(future)
+
+
+def _detach(frozen: FrozenResult) -> FrozenResult:
+    """
+    frozen result over new detached copies of its models
+    """
+    if not frozen.data:
+        return frozen
+    if frozen._source_supports_scalars:
+        if not isinstance(frozen.data[0], SqlModel):
+            return frozen
+        data = [cache.detached(type(item), cache.column_values(item)) for item in frozen.data]
+    else:
+        if not any(isinstance(value, SqlModel) for value in frozen.data[0]):
+            return frozen
+        data = [
+            tuple(
+                cache.detached(type(value), cache.column_values(value)) if isinstance(value, SqlModel) else value
+                for value in row
+            )
+            for row in frozen.data
+        ]
+    res = FrozenResult.__new__(FrozenResult)
+    res.__dict__.update(frozen.__dict__)
+    res.data = data
+    return res
+
+
+async def _read(session: AsyncSession, statement, params) -> Tuple[FrozenResult, bool]:
+    res = await _freeze(session.execute(statement, params))
+    return res, session.info.get('replica_read', False)
+
+
+async def _freeze(result) -> FrozenResult:
+    result = await result
+    try:
+        return result.freeze()
+    except TypeError:
+        # metadata of textual results can not be frozen by some sqlalchemy 1.4 releases
+        frozen = FrozenResult.__new__(FrozenResult)
+        frozen.metadata = SimpleResultMetaData(list(result.keys()))
+        frozen._source_supports_scalars = False
+        frozen._attributes = result._attributes
+        frozen.data = [tuple(row) for row in result.all()]
+        return frozen
+
+
 @functools.lru_cache
 def _model(service: type) -> Model:
     return _service.generic_model(service)
+
+
+def _primary_key(model: type, statement: Select) -> Optional[int]:
+    clause = statement.whereclause
+    if (
+        len(statement.column_descriptions) != 1
+        or statement.column_descriptions[0]['entity'] is not model
+        or statement.get_final_froms() != [model.__table__]
+        or statement._group_by_clauses
+        or not isinstance(clause, BinaryExpression)
+        or clause.operator is not operators.eq
+        or not clause.left.compare(model.__table__.c.id)
+        or not isinstance(clause.right, BindParameter)
+    ):
+        return None
+    return clause.right.effective_value
+
+
+@functools.lru_cache
+def _insert_fields(model: type) -> tuple:
+    return tuple(
+        (column.name, model.__fields__.get(column.name))
+        for column in model.__table__.columns if column.name != 'id'
+    )
+
+
+def _upsert_statement(table, dialect: str, columns: Iterable[str]):
+    current_time = datetime.datetime.now()
+    if dialect == 'mysql':
+        statement = mysql.insert(table)
+        values = {name: statement.inserted[name] for name in columns}
+        values['version'] = table.c.version + 1
+        values['modify_time'] = current_time
+        return statement.on_duplicate_key_update(values)
+    if dialect == 'postgresql':
+        statement = postgresql.insert(table)
+    elif dialect == 'sqlite':
+        statement = sqlite.insert(table)
+    else:
+        raise NotImplementedError('upsert is not supported by %s' % dialect)
+    set_ = {name: statement.excluded[name] for name in columns}
+    set_['version'] = table.c.version + 1
+    set_['modify_time'] = current_time
+    return statement.on_conflict_do_update(index_elements=[table.c.id], set_=set_)
+
+
+def _insert_rows(model: type, data) -> List[dict]:
+    fields = _insert_fields(model)
+    current_time = datetime.datetime.now()
+    rows = []
+    for item in data:
+        values = item if isinstance(item, dict) else item.__dict__
+        row = {'id': values.get('id') or 0}
+        for name, field in fields:
+            if name in values:
+                row[name] = values[name]
+            else:
+                row[name] = field.get_default() if field is not None else None
+        row['version'] = 1
+        row['create_time'] = row['create_time'] or current_time
+        rows.append(row)
+    return rows
@@ -0,0 +1,223 @@
+__author__ = 'ziyan.yin'
+__describe__ = 'worker id lease'
+
+import asyncio
+import os
+import socket
+import tempfile
+import time
+import uuid
+from typing import Optional
+
+from loguru import logger
+from sqlalchemy import Table, Column, MetaData, Integer, String, BigInteger, select, update, delete
+from sqlalchemy.exc import IntegrityError
+
+from .service import SessionService
+from ..native import cursor
+
+try:
+    import fcntl
+except ImportError:  # pragma: nocover
+    fcntl = None
+
+WORKER_ID_SIZE = 1 << 8
+
+metadata = MetaData()
+worker_lease = Table(
+    'worker_lease',
+    metadata,
+    Column('worker_id', Integer(), primary_key=True, autoincrement=False),
+    Column('owner', String(128), nullable=False),
+    Column('expires_at', BigInteger(), nullable=False),
+)
+
+
+class WorkerLease:
+    __slots__ = ('worker_id', 'owner', 'expires_at', 'allocator', 'heartbeat', 'handle')
+
+    def __init__(self, worker_id: int, owner: str, expires_at: float, allocator: 'WorkerAllocator', handle=None):
+        self.worker_id = worker_id
+        self.owner = owner
+        self.expires_at = expires_at
+        self.allocator = allocator
+        self.heartbeat: Optional[asyncio.Task] = None
+        self.handle = handle
+
+    @property
+    def valid(self) -> bool:
+        return self.expires_at > time.time()
+
+    def lose(self):
+        self.expires_at = 0
+
+
+class WorkerAllocator:
+    """
+        hands out unique worker ids, a lease is kept alive by renew until released
+    """
+
+    def __init__(self, size: int = WORKER_ID_SIZE, ttl: float = 30):
+        self.size = size
+        self.ttl = ttl
+
+    async def acquire(self) -> WorkerLease:
+        raise NotImplementedError
+
+    async def renew(self, lease: WorkerLease) -> bool:
+        raise NotImplementedError
+
+    async def release(self, lease: WorkerLease):
+        raise NotImplementedError
+
+
+class FileLockAllocator(WorkerAllocator):
+    """
+        worker ids of one host, id n is held by an exclusive flock on '<directory>/worker-<n>.lock'
+        which the system drops when the process dies
+    """
+
+    def __init__(self, directory: str = None, size: int = WORKER_ID_SIZE, ttl: float = 30):
+        if fcntl is None:
+            raise NotImplementedError('file lock allocator needs fcntl')
+        super().__init__(size, ttl)
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'basex-workers')
+        os.makedirs(self.directory, exist_ok=True)
+
+    async def acquire(self) -> WorkerLease:
+        for worker_id in range(self.size):
+            fd = os.open(os.path.join(self.directory, 'worker-%d.lock' % worker_id), os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            owner = _owner()
+            os.ftruncate(fd, 0)
+            os.write(fd, owner.encode())
+            return WorkerLease(worker_id, owner, time.time() + self.ttl, self, fd)
+        raise RuntimeError('all %d worker ids are in use' % self.size)
+
+    async def renew(self, lease: WorkerLease) -> bool:
+        try:
+            os.fstat(lease.handle)
+        except OSError:
+            return False
+        lease.expires_at = time.time() + self.ttl
+        return True
+
+    async def release(self, lease: WorkerLease):
+        if lease.handle is not None:
+            fcntl.flock(lease.handle, fcntl.LOCK_UN)
+            os.close(lease.handle)
+            lease.handle = None
+        lease.lose()
+
+
+class DatasourceAllocator(WorkerAllocator, SessionService):
+    """
+        worker ids shared by several hosts, leases are rows of table 'worker_lease' in a datasource
+    """
+
+    def __init__(self, datasource: str = 'default', size: int = WORKER_ID_SIZE, ttl: float = 30, margin: float = None):
+        """
+        :param margin: seconds the local lease expires before the stored one, against clock skew
+            between hosts, a third of ttl by default
+        """
+        super().__init__(size, ttl)
+        self._datasource = datasource
+        self.margin = ttl / 3 if margin is None else margin
+
+    @property
+    def datasource(self) -> str:
+        return self._datasource
+
+    async def acquire(self) -> WorkerLease:
+        owner = _owner()
+        now = time.time()
+        leased = {
+            row.worker_id: row.expires_at
+            for row in (await self.execute(select(worker_lease.c.worker_id, worker_lease.c.expires_at))).all()
+        }
+        for worker_id in range(self.size):
+            expires_at = time.time() + self.ttl
+            if worker_id not in leased:
+                try:
+                    await self.execute(
+                        worker_lease.insert().values(worker_id=worker_id, owner=owner, expires_at=int(expires_at))
+                    )
+                except IntegrityError:
+                    continue
+                return WorkerLease(worker_id, owner, expires_at - self.margin, self)
+            if leased[worker_id] < now:
+                res = await self.execute(
+                    update(worker_lease).where(
+                        worker_lease.c.worker_id == worker_id,
+                        worker_lease.c.expires_at < int(now)
+                    ).values(owner=owner, expires_at=int(expires_at))
+                )
+                if res.rowcount == 1:
+                    return WorkerLease(worker_id, owner, expires_at - self.margin, self)
+        raise RuntimeError('all %d worker ids are in use' % self.size)
+
+    async def renew(self, lease: WorkerLease) -> bool:
+        expires_at = time.time() + self.ttl
+        res = await self.execute(
+            update(worker_lease).where(
+                worker_lease.c.worker_id == lease.worker_id,
+                worker_lease.c.owner == lease.owner
+            ).values(expires_at=int(expires_at))
+        )
+        if res.rowcount != 1:
+            return False
+        lease.expires_at = expires_at - self.margin
+        return True
+
+    async def release(self, lease: WorkerLease):
+        lease.lose()
+        await self.execute(
+            delete(worker_lease).where(
+                worker_lease.c.worker_id == lease.worker_id,
+                worker_lease.c.owner == lease.owner
+            )
+        )
+
+
+async def lease_worker_id(allocator: WorkerAllocator, interval: float = None) -> WorkerLease:
+    """
+    acquire a worker id for all cursors of this process and keep it alive in background,
+    call it in every worker after fork
+
+    :param allocator: FileLockAllocator for one host, DatasourceAllocator for several hosts
+    :param interval: seconds between renewals, a third of ttl by default
+    :return: lease
+    """
+    lease = await allocator.acquire()
+    cursor.bind_lease(lease)
+    lease.heartbeat = asyncio.create_task(_heartbeat(lease, interval or allocator.ttl / 3))
+    logger.info('worker id %d leased by %s' % (lease.worker_id, lease.owner))
+    return lease
+
+
+async def release_worker_id(lease: WorkerLease):
+    if lease.heartbeat is not None:
+        lease.heartbeat.cancel()
+    await lease.allocator.release(lease)
+    if cursor.current_lease() is lease:
+        cursor.bind_lease(None)
+
+
+async def _heartbeat(lease: WorkerLease, interval: float):
+    while lease.valid:
+        await asyncio.sleep(interval)
+        try:
+            if not await lease.allocator.renew(lease):
+                logger.error('worker id %d lease is taken by another worker' % lease.worker_id)
+                lease.lose()
+        except Exception as ex:
+            # keep retrying until expires_at, cursors refuse ids after that
+            logger.exception(ex)
+
+
+def _owner() -> str:
+    return '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
@@ -23,6 +23,8 @@ def get_table_name(name) -> str:
 
 class SqlModel(_Model, table=False):
     __bind_key__ = 'default'
+    # bit widths of id cursor, e.g. {'sequence_bits': 12, 'machine_bits': 8, 'time_bits': 43}
+    __cursor_bits__: dict = {}
     id: int = Field(
         default_factory=lambda: 0,
         sa_column=Column(BigInteger(), primary_key=True, autoincrement=False)
@@ -35,7 +37,8 @@ class SqlModel(_Model, table=False):
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
         cls.__tablename__ = get_table_name(cls.__name__)
-        cls.__fields__['id'].default_factory = Cursor().next_val
+        cls.__cursor__ = Cursor(**cls.__cursor_bits__)
+        cls.__fields__['id'].default_factory = cls.__cursor__.next_val
 
     @declared_attr
     def __mapper_args__(cls) -> dict:
@@ -1,19 +1,99 @@
 __author__ = 'ziyan.yin'
 __describe__ = 'session'
 
-from typing import Type, Dict, Union
+import functools
+import inspect
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import Type, Dict, Union, Optional, AsyncIterator, List, Callable
 
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, AsyncSessionTransaction
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, AsyncSessionTransaction, AsyncEngine
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.elements import TextClause
 
 from .mapper import SqlModel
 from ..config import settings
 from ..config.context import ContextWrapper
 from ..native import logstash
 
+REPLICA_KEYS = ('replicas', 'replica_strategy', 'read_your_writes')
+
 engine: dict = {}
 create_session: sessionmaker
 transaction_group: Dict[str, ContextWrapper[AsyncSessionTransaction]] = {}
+replica_group: Dict[str, 'ReplicaSet'] = {}
+write_group: Dict[str, ContextWrapper[float]] = {}
+
+
+class ReplicaSet:
+    """
+        read replicas of a datasource, picked round robin or by least checked out connections
+    """
+
+    def __init__(self, engines: List[AsyncEngine], strategy: str = 'round_robin', read_your_writes: float = 1):
+        if strategy not in ('round_robin', 'least_outstanding'):
+            raise ValueError('unknown replica strategy %s' % strategy)
+        self.engines = engines
+        self.strategy = strategy
+        self.read_your_writes = read_your_writes
+        self.outstanding: Dict[AsyncEngine, int] = {replica: 0 for replica in engines}
+        self._cycle = itertools.cycle(engines)
+        for replica in engines:
+            # counted by pool events since not every pool class can report checked out connections
+            event.listen(replica.sync_engine, 'checkout', functools.partial(self._checkout, replica, 1))
+            event.listen(replica.sync_engine, 'checkin', functools.partial(self._checkout, replica, -1))
+
+    def choose(self) -> AsyncEngine:
+        if self.strategy == 'least_outstanding':
+            return min(self.engines, key=self.outstanding.__getitem__)
+        return next(self._cycle)
+
+    def _checkout(self, replica: AsyncEngine, count: int, *args):
+        self.outstanding[replica] += count
+
+
+class UnitOfWork:
+    """
+        sessions shared by the service calls of one request, one per datasource opened on first use,
+        writes stay pending until a single flush and commit when the unit ends
+    """
+
+    def __init__(self):
+        self.sessions: Dict[str, AsyncSession] = {}
+
+    def session(self, database: str = 'default') -> AsyncSession:
+        if (session := self.sessions.get(database)) is None:
+            session = self.sessions[database] = create_session(info={'database': database, 'replica': True})
+        return session
+
+    async def commit(self):
+        sessions, self.sessions = self.sessions, {}
+        try:
+            for session in sessions.values():
+                await session.commit()
+        except Exception:
+            for session in sessions.values():
+                await session.rollback()
+            raise
+        finally:
+            for session in sessions.values():
+                await session.close()
+        for session in sessions.values():
+            await _run_after_commit(session)
+
+    async def rollback(self):
+        sessions, self.sessions = self.sessions, {}
+        for session in sessions.values():
+            try:
+                await session.rollback()
+            finally:
+                await session.close()
+
+
+work_group: ContextWrapper[UnitOfWork] = ContextWrapper[UnitOfWork]('unit_of_work')
 
 
 def initial_engine():
@@ -22,10 +102,20 @@ def initial_engine():
     global transaction_group
     for tag, db in settings.datasource.items():
         transaction_group[tag] = ContextWrapper[AsyncSessionTransaction]('transaction')
+        write_group[tag] = ContextWrapper[float]('last_write', default=0)
         if tag != 'expire_on_commit':
             engine[tag] = create_async_engine(
-                **{k: v for k, v in db.items() if k not in ('package', 'expire_on_commit')}
+                **{k: v for k, v in db.items() if k not in ('package', 'expire_on_commit', *REPLICA_KEYS)}
             )
+            if replicas := db.get('replicas'):
+                replica_group[tag] = ReplicaSet(
+                    [
+                        create_async_engine(replica) if isinstance(replica, str) else create_async_engine(**replica)
+                        for replica in replicas
+                    ],
+                    db.get('replica_strategy', 'round_robin'),
+                    db.get('read_your_writes', 1)
+                )
 
     create_session = sessionmaker(
         expire_on_commit=settings.datasource.get('expire_on_commit', default=False),
@@ -44,20 +134,117 @@ def bind_database(database: str):
     return wrapper
 
 
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[UnitOfWork]:
+    """
+    share one session per datasource among service calls in this context and commit once at exit,
+    rollback if an exception escapes, joins the outer unit when nested
+    """
+    if (work := work_group.value) is not None:
+        yield work
+        return
+    work = UnitOfWork()
+    token = work_group.set(work)
+    try:
+        yield work
+    except BaseException:
+        await work.rollback()
+        raise
+    else:
+        await work.commit()
+    finally:
+        work_group.reset(token)
+
+
+class UnitOfWorkMiddleware:
+    """
+        ASGI middleware running each http request in a unit of work, which is committed before
+        the response starts if its status is below 400 and rolled back otherwise
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        async with unit_of_work() as work:
+            async def _send(message):
+                if message['type'] == 'http.response.start':
+                    if message['status'] < 400:
+                        await work.commit()
+                    else:
+                        await work.rollback()
+                await send(message)
+
+            await self.app(scope, receive, _send)
+
+
+def work_session(database: str = 'default') -> Optional[AsyncSession]:
+    """
+    session of current unit of work, None outside a unit or inside a transactional call
+    """
+    database = database or 'default'
+    if (work := work_group.value) is None or transaction_group[database].value:
+        return None
+    return work.session(database)
+
+
+def get_dialect(database: str = 'default'):
+    return engine[database or 'default'].dialect
+
+
+def bound_session(database: str = 'default') -> Optional[AsyncSessionTransaction]:
+    """
+    session shared by the current context, service calls must not run concurrently on it
+    """
+    database = database or 'default'
+    if transaction := transaction_group[database].value:
+        return transaction
+    if (work := work_group.value) is not None:
+        return work.session(database)
+    return None
+
+
+def after_commit(database: str, callback: Callable) -> bool:
+    """
+    queue callback until the transaction or unit of work bound to current context commits,
+    it is dropped if they roll back
+
+    :param database: datasource
+    :param callback: function without arguments, awaited if it returns an awaitable
+    :return: False if no session is bound, callback is not queued then
+    """
+    if (bound := bound_session(database)) is None:
+        return False
+    session = bound.session if isinstance(bound, AsyncSessionTransaction) else bound
+    session.info.setdefault('after_commit', []).append(callback)
+    return True
+
+
+async def _run_after_commit(session: AsyncSession):
+    for callback in session.info.pop('after_commit', ()):
+        if inspect.isawaitable(res := callback()):
+            await res
+
+
 def session_factory(database: str = 'default') -> Union[AsyncSession, AsyncSessionTransaction]:
     database = database or 'default'
     session = transaction_group[database].value
     if session:
         return session
     else:
-        return create_session()
+        return create_session(info={'database': database, 'replica': True})
 
 
 def transactional(rollback_for: Type[Exception] = Exception):
     def wrapper(func):
         async def inner(self, *args, **kwargs):
+            if work := work_session(self.datasource):
+                return await _nested_transactional(work, rollback_for, func, self, *args, **kwargs)
             if not transaction_group[self.datasource].value:
-                async with create_session() as session:
+                async with create_session(info={'database': self.datasource}) as session:
                     token = transaction_group[self.datasource].set(session.begin_nested())
                     try:
                         res = await func(self, *args, **kwargs)
@@ -66,9 +253,11 @@ def transactional(rollback_for: Type[Exception] = Exception):
                             await session.rollback()
                         else:
                             await session.commit()
+                            await _run_after_commit(session)
                         raise
                     else:
                         await session.commit()
+                        await _run_after_commit(session)
                         return res
                     finally:
                         transaction_group[self.datasource].reset(token)
@@ -79,9 +268,73 @@ def transactional(rollback_for: Type[Exception] = Exception):
     return wrapper
 
 
+async def _nested_transactional(session: AsyncSession, rollback_for: Type[Exception], func, self, *args, **kwargs):
+    # inside a unit of work a transactional call is a savepoint of its session, read on the primary
+    savepoint = await session.begin_nested()
+    token = transaction_group[self.datasource].set(session.begin_nested())
+    session.info['transactional'] = session.info.get('transactional', 0) + 1
+    try:
+        res = await func(self, *args, **kwargs)
+    except Exception as ex:
+        if issubclass(ex.__class__, rollback_for):
+            await savepoint.rollback()
+        else:
+            await savepoint.commit()
+        raise
+    else:
+        await savepoint.commit()
+        return res
+    finally:
+        session.info['transactional'] -= 1
+        transaction_group[self.datasource].reset(token)
+
+
+def wrote_recently(database: str = 'default') -> bool:
+    """
+    whether current context wrote to database within read_your_writes seconds (1 without replicas),
+    its reads must not go to replicas or join reads which may have started before the write
+    """
+    database = database or 'default'
+    if not (last := write_group[database].value):
+        return False
+    replicas = replica_group.get(database)
+    return last + (replicas.read_your_writes if replicas else 1) >= time.monotonic()
+
+
+def is_read(clause) -> bool:
+    """
+    whether clause is a select without FOR UPDATE, which may be served by a replica or a cache
+    """
+    if isinstance(clause, Select):
+        return clause._for_update_arg is None
+    if isinstance(clause, TextClause):
+        sql = clause.text.lstrip().lower()
+        return sql.startswith('select') and 'for update' not in sql
+    return False
+
+
 class RoutingSession(Session):
+    """
+        routes a statement to the engine of its model's bind key, or of the datasource the session
+        was opened for, plain selects of a single call or unit of work session go to a replica unless
+        the context wrote to the datasource within read_your_writes seconds, the session itself wrote
+        or a transactional call is running on it
+    """
 
     def get_bind(self, mapper=None, clause=None, **kw):
-        if mapper and isinstance(mapper, SqlModel):
-            return engine[mapper.__bind_key__].sync_engine
-        return engine['default'].sync_engine
+        if mapper is not None and issubclass(mapper.class_, SqlModel):
+            database = mapper.class_.__bind_key__
+        else:
+            database = self.info.get('database') or 'default'
+
+        if is_read(clause) and not self._flushing:
+            if self.info.get('replica') and not self.info.get('transactional'):
+                if (replicas := replica_group.get(database)) and not wrote_recently(database):
+                    self.info['replica_read'] = True
+                    return replicas.choose().sync_engine
+        else:
+            # uncommitted writes are only visible on the primary connection of this session
+            self.info['replica'] = False
+            if database in write_group:
+                write_group[database].set(time.monotonic())
+        return engine[database].sync_engine
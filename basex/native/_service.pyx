@@ -8,6 +8,7 @@ from cpython.set cimport PySet_Contains
 from cpython.dict cimport PyDict_Contains, PyDict_SetItem, PyDict_Items
 
 cdef object _build_in = frozenset({'id','version','create_time','modify_time', 'deleted'})
+build_in = _build_in
 
 
 cpdef void update(object model, bint ignore_none, object kwargs):
@@ -28,13 +29,28 @@ cpdef void update_batch(list models, bint ignore_none, object kwargs):
         update(model, ignore_none, kwargs)
 
 
+cpdef dict update_values(object columns, bint ignore_none, object kwargs):
+    cdef dict res = {}
+    for key, value in PyDict_Items(kwargs):
+        if ignore_none and value is None:
+            continue
+        if PySet_Contains(_build_in, key):
+            continue
+        if key in columns:
+            res[key] = value
+    return res
+
+
 
 @cython.cdivision(True)
 cpdef void paginate(object page, object columns, object stmt, long long total):
     cdef int size = page.size
     page.total = total
     page.pages = ((total - 1) / size) + 1
+    order_by(page, columns, stmt)
+
 
+cpdef void order_by(object page, object columns, object stmt):
     if PyList_Check(page.orders) and PyList_Size(page.orders) > 0:
         stmt._order_by_clauses = [
             PyObject_GetAttr(columns, order.column) if order.asc else PyObject_GetAttr(columns, order.column).desc()
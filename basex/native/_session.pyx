@@ -1,18 +1,21 @@
 __author__ = 'ziyan.yin'
 __describe__ = ''
 
-from collections import Callable
-from typing import Any, Awaitable, AsyncGenerator
+from typing import Any, Awaitable, AsyncGenerator, Callable
 
 cimport cython
 from loguru import logger
 from sqlalchemy.ext.asyncio import AsyncSession, AsyncSessionTransaction
 
-from ..db.session import session_factory
+from ..db.session import session_factory, work_session
 
 
 @cython.infer_types(True)
 async def method_wrapper(func: Callable[[AsyncSession], Any], database: str = 'default') -> Any:
+    work = work_session(database)
+    if work is not None:
+        # pending until the unit of work flushes and commits
+        return func(work)
     async with session_factory(database) as session:
         if isinstance(session, AsyncSessionTransaction):
             cursor = session.session
@@ -30,6 +33,9 @@ async def method_wrapper(func: Callable[[AsyncSession], Any], database: str = 'd
 
 @cython.infer_types(True)
 async def execute_wrapper(executable: Callable[[AsyncSession], Awaitable[Any]], database: str = 'default') -> Any:
+    work = work_session(database)
+    if work is not None:
+        return await executable(work)
     async with session_factory(database) as session:
         if isinstance(session, AsyncSessionTransaction):
             cursor = session.session
@@ -47,6 +53,11 @@ async def execute_wrapper(executable: Callable[[AsyncSession], Awaitable[Any]],
 
 @cython.infer_types(True)
 async def stream_wrapper(stream: Callable[[AsyncSession], Any], database: str = 'default') -> AsyncGenerator:
+    work = work_session(database)
+    if work is not None:
+        async for row in (await stream(work)):
+            yield row
+        return
     async with session_factory(database) as session:
         if isinstance(session, AsyncSessionTransaction):
             cursor = session.session
@@ -1,6 +1,7 @@
 __author__ = 'ziyan.yin'
 __describe__ = 'flake sequence'
 
+import asyncio
 import datetime
 import time
 import os
@@ -8,34 +9,190 @@ import os
 cimport cython
 
 cdef int _sequence_length = 8
-cdef int _machine_id = (os.getpid() % 0x100)
+cdef int _machine_length = 8
+cdef int _time_length = 47
+cdef long long _machine_id = os.getpid()
+cdef object _lease = None
 cdef double _start_point = datetime.datetime(2020, 1, 1).timestamp()
+cdef double _tick = 0.1
+
+
+def bind_lease(object lease):
+    """
+    use lease.worker_id as machine id of every cursor, ids are refused once lease.expires_at has passed
+
+    :param lease: object with worker_id and expires_at(unix time), None to fall back to pid
+    """
+    global _machine_id, _lease
+    if lease is None:
+        _machine_id = os.getpid()
+    else:
+        _machine_id = lease.worker_id
+    _lease = lease
+
+
+def current_lease():
+    return _lease
 
 
 cdef class Cursor:
-    cdef int cursor
+    """
+        id = timestamp(100ms since 2020-01-01) | machine | sequence, bit widths are configurable
+        as long as they fit 63 bits, a wider sequence gives more ids per tick and a shorter time range
+    """
+    cdef readonly int sequence_bits
+    cdef readonly int machine_bits
+    cdef readonly int time_bits
+    cdef long long cursor
     cdef long long last_point
+    cdef long long reserved
 
-    def __init__(self):
+    def __init__(self, int sequence_bits=_sequence_length, int machine_bits=_machine_length, int time_bits=_time_length):
+        if sequence_bits < 1 or machine_bits < 0 or time_bits < 1 or sequence_bits + machine_bits + time_bits > 63:
+            raise ValueError('sequence, machine and time bits must be positive and fit in 63 bits')
+        self.sequence_bits = sequence_bits
+        self.machine_bits = machine_bits
+        self.time_bits = time_bits
         self.cursor = 0
         self.last_point = 0
+        self.reserved = 0
+
+    @property
+    def machine_id(self) -> int:
+        return self.machine()
+
+    cdef inline long long machine(self):
+        return _machine_id & (((<long long>1) << self.machine_bits) - 1)
+
+    cdef inline long long compose(self, long long point, long long count):
+        return (point << (self.sequence_bits + self.machine_bits)) + (self.machine() << self.sequence_bits) + count
+
+    @cython.infer_types(True)
+    def decode(self, long long value) -> tuple:
+        """
+        split id into parts
+
+        :param value: id generated by a cursor with same bit widths
+        :return: (datetime of its tick, machine id, sequence)
+        """
+        sequence = value & (((<long long>1) << self.sequence_bits) - 1)
+        machine = (value >> self.sequence_bits) & (((<long long>1) << self.machine_bits) - 1)
+        point = value >> (self.sequence_bits + self.machine_bits)
+        return datetime.datetime.fromtimestamp(_start_point + point * _tick), machine, sequence
+
+    @cython.infer_types(True)
+    def id_range(self, object start, object end) -> tuple:
+        """
+        bounds of ids generated between start and end
+
+        :param start: datetime or unix time
+        :param end: datetime or unix time
+        :return: (id_min, id_max), both inclusive
+        """
+        shift = self.sequence_bits + self.machine_bits
+        return self.point(start) << shift, ((self.point(end) + 1) << shift) - 1
 
-    cdef inline long long fetch(self):
-        cdef long long count = 0
-        cdef long long point = int((time.time() - _start_point) * 10)
+    cdef long long point(self, object value) except? -1:
+        if isinstance(value, datetime.datetime):
+            value = value.timestamp()
+        cdef long long point = <long long>((value - _start_point) / _tick)
+        if point < 0:
+            return 0
+        if point >> self.time_bits:
+            return ((<long long>1) << self.time_bits) - 1
+        return point
 
-        if self.last_point == point:
-            count = self.cursor + 1
-            if count > (1 << _sequence_length):
-                return 0
-        else:
+    cdef long long reserve(self, long long n) except -1:
+        """
+        reserve up to n sequences of current tick, the first one is kept in self.reserved
+        """
+        cdef double now = time.time()
+        cdef long long point = <long long>((now - _start_point) / _tick)
+        cdef long long available
+
+        if _lease is not None:
+            if _lease.expires_at <= now:
+                raise RuntimeError('worker id lease %d is lost, refuse to generate ids' % _lease.worker_id)
+            if _machine_id >> self.machine_bits:
+                raise ValueError('worker id %d does not fit in %d bits' % (_machine_id, self.machine_bits))
+
+        if point > self.last_point:
+            if point >> self.time_bits:
+                raise OverflowError('timestamp does not fit in %d bits' % self.time_bits)
             self.last_point = point
-        self.cursor = count
-        return (self.last_point << (_sequence_length + 8)) + (_machine_id << _sequence_length) + count
+            self.cursor = 0
+        # a clock moving backwards keeps using the last tick until it catches up
+        available = ((<long long>1) << self.sequence_bits) - self.cursor
+        if available <= 0:
+            return 0
+        if n > available:
+            n = available
+        self.reserved = self.cursor
+        self.cursor += n
+        return n
+
+    cdef inline double wait(self):
+        """
+        seconds until the tick after the last one
+        """
+        cdef double delay = _start_point + (self.last_point + 1) * _tick - time.time()
+        return delay if delay > 0 else 0
 
     @cython.infer_types(True)
     def next_val(self) -> int:
-        index = self.fetch()
-        while index == 0:
-            index = self.fetch()
-        return index
+        while self.reserve(1) == 0:
+            time.sleep(self.wait())
+        return self.compose(self.last_point, self.reserved)
+
+    @cython.infer_types(True)
+    def next_batch(self, long long n) -> list:
+        """
+        reserve n ids, contiguous within each tick, sleeps instead of spinning when a tick is used up
+
+        :param n: count of ids
+        :return: ids in ascending order
+        """
+        cdef list res = []
+        cdef long long count
+        cdef long long first
+        while n > 0:
+            count = self.reserve(n)
+            if count == 0:
+                time.sleep(self.wait())
+                continue
+            first = self.compose(self.last_point, self.reserved)
+            res.extend(range(first, first + count))
+            n -= count
+        return res
+
+    async def next_batch_async(self, long long n) -> list:
+        """
+        async variant of next_batch, yields to event loop while waiting for next tick
+        """
+        res = []
+        while n > 0:
+            count = self.reserve(n)
+            if count == 0:
+                await asyncio.sleep(self.wait())
+                continue
+            first = self.compose(self.last_point, self.reserved)
+            res.extend(range(first, first + count))
+            n -= count
+        return res
+
+
+_default = Cursor()
+
+
+def decode_id(long long value) -> tuple:
+    """
+    split id of default bit widths into (datetime, machine id, sequence)
+    """
+    return _default.decode(value)
+
+
+def id_range(object start, object end) -> tuple:
+    """
+    inclusive bounds of ids of default bit widths generated between start and end
+    """
+    return _default.id_range(start, end)
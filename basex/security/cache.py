@@ -0,0 +1,78 @@
+__author__ = 'ziyan.yin'
+__describe__ = 'verified token cache'
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import Optional, Hashable
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class TokenCache:
+    """
+        bounded lru of verified claims, an entry is dropped as soon as its 'exp' has passed
+    """
+    __slots__ = ('maxsize', 'hits', 'misses', '_data', '_lock')
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, leeway: int = 0) -> Optional[dict]:
+        current = time.time()
+        now = int(current)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                claims, nbf, exp, expires = entry
+                if (
+                    (exp is not None and exp < (now - leeway))
+                    or (nbf is not None and nbf > (now + leeway))
+                    or (expires is not None and expires <= current)
+                ):
+                    del self._data[key]
+                else:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return dict(claims)
+            self.misses += 1
+        return None
+
+    def put(self, key: Hashable, claims: dict, expires: float = None):
+        """
+        :param key: cache key
+        :param claims: verified claims
+        :param expires: drop the entry from this time on even if the token is still valid, e.g. key expiry
+        """
+        nbf = int(claims["nbf"]) if "nbf" in claims else None
+        exp = int(claims["exp"]) if "exp" in claims else None
+        with self._lock:
+            self._data[key] = (dict(claims), nbf, exp, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def purge(self, leeway: int = 0) -> int:
+        current = time.time()
+        now = int(current)
+        with self._lock:
+            expired = [
+                key for key, (_, _, exp, expires) in self._data.items()
+                if (exp is not None and exp < (now - leeway)) or (expires is not None and expires <= current)
+            ]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
@@ -1,8 +1,13 @@
 __author__ = 'ziyan.yin'
 __describe__ = 'jws native'
 
+import datetime
+import functools
 import hashlib
 import hmac
+import threading
+import time
+from typing import Union, Optional, Dict, List
 
 from .exceptions import JWKError
 
@@ -11,27 +16,157 @@ HASHES = {
     'HS384': hashlib.sha384,
     'HS512': hashlib.sha512
 }
+INVALID_STRINGS = (
+    b"-----BEGIN PUBLIC KEY-----",
+    b"-----BEGIN RSA PUBLIC KEY-----",
+    b"-----BEGIN CERTIFICATE-----",
+    b"ssh-rsa",
+)
+KEY_CACHE_SIZE = 256
 
 
 class HMACKey:
+    __slots__ = ('algorithm', 'prepared_key', 'kid', 'not_before', 'expires', '_hash_alg', '_hmac')
 
-    def __init__(self, key: bytes, algorithm: str):
-        self._hash_alg = HASHES.get(algorithm)
-        invalid_strings = (
-            b"-----BEGIN PUBLIC KEY-----",
-            b"-----BEGIN RSA PUBLIC KEY-----",
-            b"-----BEGIN CERTIFICATE-----",
-            b"ssh-rsa",
-        )
-        if any(string_value in key for string_value in invalid_strings):
+    def __init__(
+        self,
+        key: Union[str, bytes],
+        algorithm: str,
+        kid: str = None,
+        not_before: float = None,
+        expires: float = None
+    ):
+        if algorithm not in HASHES:
+            raise JWKError("Algorithm %s not supported." % algorithm)
+        if isinstance(key, str):
+            key = key.encode()
+        if any(string_value in key for string_value in INVALID_STRINGS):
             raise JWKError(
                 "The specified key is an asymmetric key or x509 certificate and"
                 " should not be used as an HMAC secret."
             )
+        self.algorithm = algorithm
         self.prepared_key = key
+        self.kid = kid
+        self.not_before = not_before
+        self.expires = expires
+        self._hash_alg = HASHES[algorithm]
+        # keyed once, every signature starts from a copy of this state
+        self._hmac = hmac.new(key, digestmod=self._hash_alg)
+
+    def new(self, msg=None):
+        """
+        get a copy of the keyed hmac state, fed with msg if given
+        """
+        h = self._hmac.copy()
+        if msg is not None:
+            h.update(msg)
+        return h
 
     def sign(self, msg):
-        return hmac.new(self.prepared_key, msg, self._hash_alg).digest()
+        return self.new(msg).digest()
 
     def verify(self, msg, sig):
         return hmac.compare_digest(sig, self.sign(msg))
+
+    def active(self, now: float) -> bool:
+        if self.not_before is not None and now < self.not_before:
+            return False
+        if self.expires is not None and now >= self.expires:
+            return False
+        return True
+
+
+class KeySet:
+    """
+        prepared keys indexed by kid, tokens are signed by the newest active key
+        and verified by the key their 'kid' header names
+
+            >>> keys = KeySet()
+            >>> keys.add('2022-01', 'old secret', expires=datetime.datetime(2022, 3, 1))
+            >>> keys.add('2022-02', 'new secret', not_before=datetime.datetime(2022, 2, 1))
+            >>> token = jwt.encode(claims, keys)
+    """
+    __slots__ = ('version', '_keys', '_ordered', '_lock')
+
+    def __init__(self):
+        self.version = 0
+        self._keys: Dict[str, HMACKey] = {}
+        self._ordered: List[HMACKey] = []
+        self._lock = threading.Lock()
+
+    def add(
+        self,
+        kid: str,
+        key: Union[str, bytes],
+        algorithm: str = 'HS256',
+        not_before: Union[datetime.datetime, float, None] = None,
+        expires: Union[datetime.datetime, float, None] = None
+    ) -> HMACKey:
+        """
+        add a key, it signs tokens from not_before and verifies them until expires
+
+        :param kid: key id stamped in token header
+        :param key: secret
+        :param algorithm: HS256, HS384 or HS512
+        :param not_before: activation time
+        :param expires: expiry time
+        :return: HMACKey
+        """
+        prepared = HMACKey(key, algorithm, kid, _timestamp(not_before), _timestamp(expires))
+        with self._lock:
+            keys = dict(self._keys)
+            keys[kid] = prepared
+            self._update(keys)
+        return prepared
+
+    def remove(self, kid: str):
+        with self._lock:
+            keys = dict(self._keys)
+            keys.pop(kid, None)
+            self._update(keys)
+
+    def get(self, kid: Optional[str], now: float = None) -> HMACKey:
+        if not isinstance(kid, str) or (key := self._keys.get(kid)) is None:
+            raise JWKError("Unknown key id: %s" % kid)
+        if not key.active(time.time() if now is None else now):
+            raise JWKError("Key %s is not active." % kid)
+        return key
+
+    def signing_key(self, now: float = None) -> HMACKey:
+        if now is None:
+            now = time.time()
+        for key in self._ordered:
+            if key.active(now):
+                return key
+        raise JWKError("No active key in key set.")
+
+    def _update(self, keys: Dict[str, HMACKey]):
+        # readers never lock, both views are replaced at once
+        self._ordered = sorted(keys.values(), key=lambda x: x.not_before or 0, reverse=True)
+        self._keys = keys
+        self.version += 1
+
+    def __contains__(self, kid):
+        return kid in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def _timestamp(value: Union[datetime.datetime, float, None]) -> Optional[float]:
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return value
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def prepare_key(key: Union[str, bytes], algorithm: str) -> HMACKey:
+    """
+    get the prepared key of (key, algorithm), raw keys are kept in a bounded cache
+
+    :param key: secret
+    :param algorithm: HS256, HS384 or HS512
+    :return: HMACKey
+    """
+    return HMACKey(key, algorithm)
@@ -2,43 +2,78 @@ __author__ = 'ziyan.yin'
 __describe__ = 'jwt tools'
 
 import binascii
-from typing import Mapping
+import functools
+import hmac
+import re
+from typing import Mapping, Tuple, Union, AsyncIterable
 
 import orjson
 
-from .exceptions import JWSSignatureError, JWSError
-from .jwk import HMACKey
+from .exceptions import JWSSignatureError, JWSError, JWKError
+from .jwk import HMACKey, KeySet, HASHES, prepare_key
 from ..common import cryptutils
 
+_SEGMENTS = re.compile(rb'([^.]*)\.([^.]*)\.([^.]*)')
+
 
 def verify(signing_input, signature, key, algorithm):
-    if not HMACKey(key.encode(), algorithm).verify(signing_input, signature):
+    if not get_key(key, algorithm).verify(signing_input, signature):
         raise JWSSignatureError()
 
 
 def sign(data, key, algorithm):
-    return HMACKey(key.encode(), algorithm).sign(data)
+    return get_key(key, algorithm).sign(data)
 
 
-def load(token):
+def get_key(key, algorithm) -> HMACKey:
+    if isinstance(key, HMACKey):
+        if key.algorithm != algorithm:
+            raise JWKError("The specified key is prepared for %s, not %s." % (key.algorithm, algorithm))
+        return key
+    return prepare_key(key, algorithm)
+
+
+def split(token: Union[str, bytes, memoryview]) -> Tuple[memoryview, memoryview, memoryview, memoryview]:
+    """
+    split token into header, claims, signing input and crypto segments, bytes and
+    memoryview tokens are sliced without copy
+
+    :param token: compact serialized token
+    :return: memoryview of each segment
+    """
     if isinstance(token, str):
         token = token.encode("utf-8")
+    view = memoryview(token)
+    match = _SEGMENTS.fullmatch(view)
+    if match is None:
+        raise JWSError("Not enough segments")
+    return (
+        view[:match.end(1)],
+        view[match.start(2):match.end(2)],
+        view[:match.end(2)],
+        view[match.start(3):]
+    )
+
+
+def load_header(header_segment) -> Mapping:
     try:
-        signing_input, crypto_segment = token.rsplit(b".", 1)
-        header_segment, claims_segment = signing_input.split(b".", 1)
         header_data = b64decode(header_segment)
-    except ValueError:
-        raise JWSError("Not enough segments")
-    except TypeError:
+    except (TypeError, binascii.Error):
         raise JWSError("Invalid header padding")
 
     try:
-        header = orjson.loads(header_data.decode("utf-8"))
+        header = orjson.loads(header_data)
     except ValueError as e:
         raise JWSError("Invalid header string: %s" % e)
 
     if not isinstance(header, Mapping):
         raise JWSError("Invalid header string: must be a json object")
+    return header
+
+
+def load(token):
+    header_segment, claims_segment, signing_input, crypto_segment = split(token)
+    header = load_header(header_segment)
 
     try:
         payload = b64decode(claims_segment)
@@ -50,13 +85,156 @@ def load(token):
     except (TypeError, binascii.Error):
         raise JWSError("Invalid crypto padding")
 
-    return header, payload, signing_input, signature
+    return header, payload, signing_input.tobytes(), signature
+
+
+def load_verified(token, key, algorithm=None) -> Tuple[Mapping, bytes, HMACKey]:
+    """
+    header first parsing, the payload is decoded only after the signature is verified
+
+    :param token: compact serialized token, bytes or memoryview are not copied
+    :param key: secret, HMACKey or KeySet
+    :param algorithm: expected algorithm, defaults to the algorithm of a prepared key or HS256
+    :return: header, payload and the key that verified the token
+    """
+    header_segment, claims_segment, signing_input, crypto_segment = split(token)
+    header = load_header(header_segment)
+    key = _resolve_key(header, key, algorithm)
+
+    if not key.verify(signing_input, _load_signature(crypto_segment)):
+        raise JWSSignatureError()
+
+    try:
+        payload = b64decode(claims_segment)
+    except (TypeError, binascii.Error):
+        raise JWSError("Invalid payload padding")
+    return header, payload, key
+
+
+def sign_detached(payload, key, algorithm='HS256', headers=None) -> str:
+    """
+    sign payload as a detached jws with unencoded payload (rfc 7797), the payload is
+    fed to hmac as it is, never encoded or copied
+
+    :param payload: bytes, bytearray or memoryview
+    :param key: secret or HMACKey
+    :param algorithm: HS256, HS384 or HS512
+    :param headers: additional headers
+    :return: token like 'header..signature'
+    """
+    key = get_key(key, algorithm)
+    header_segment = _detached_header(key, headers)
+    h = key.new(header_segment + b".")
+    h.update(payload)
+    return _detached_token(header_segment, h.digest())
+
+
+async def sign_detached_async(chunks: AsyncIterable[bytes], key, algorithm='HS256', headers=None) -> str:
+    """
+    streaming variant of `sign_detached`, e.g. for chunks of `Request.stream()`
+    """
+    key = get_key(key, algorithm)
+    header_segment = _detached_header(key, headers)
+    h = key.new(header_segment + b".")
+    async for chunk in chunks:
+        h.update(chunk)
+    return _detached_token(header_segment, h.digest())
+
+
+def verify_detached(token, payload, key, algorithm=None) -> Mapping:
+    """
+    verify a detached jws with unencoded payload against payload
+
+    :param token: token like 'header..signature'
+    :param payload: bytes, bytearray or memoryview
+    :param key: secret, HMACKey or KeySet
+    :param algorithm: expected algorithm, defaults to the algorithm of a prepared key or HS256
+    :return: header
+    """
+    header_segment, header, key, signature = _load_detached(token, key, algorithm)
+    h = key.new(header_segment)
+    h.update(payload)
+    if not hmac.compare_digest(signature, h.digest()):
+        raise JWSSignatureError()
+    return header
+
+
+async def verify_detached_async(token, chunks: AsyncIterable[bytes], key, algorithm=None) -> Mapping:
+    """
+    streaming variant of `verify_detached`, the token is checked before the first chunk is read
+    """
+    header_segment, header, key, signature = _load_detached(token, key, algorithm)
+    h = key.new(header_segment)
+    async for chunk in chunks:
+        h.update(chunk)
+    if not hmac.compare_digest(signature, h.digest()):
+        raise JWSSignatureError()
+    return header
+
+
+def _resolve_key(header, key, algorithm) -> HMACKey:
+    alg = header.get("alg")
+    if not isinstance(alg, str) or alg not in HASHES:
+        raise JWSError("Algorithm %s not supported." % alg)
+    if isinstance(key, KeySet):
+        key = key.get(header.get("kid"))
+    if algorithm is None:
+        algorithm = key.algorithm if isinstance(key, HMACKey) else 'HS256'
+    if alg != algorithm:
+        raise JWSError("The specified alg value is not allowed")
+    return get_key(key, algorithm)
+
+
+def _load_signature(crypto_segment) -> bytes:
+    try:
+        return b64decode(crypto_segment)
+    except (TypeError, binascii.Error):
+        raise JWSError("Invalid crypto padding")
+
+
+def _load_detached(token, key, algorithm):
+    header_segment, claims_segment, signing_input, crypto_segment = split(token)
+    if len(claims_segment):
+        raise JWSError("Payload of a detached token must be empty")
+    header = load_header(header_segment)
+    if header.get("b64") is not False or "b64" not in header.get("crit", ()):
+        raise JWSError("Token is not signed over an unencoded payload (b64)")
+    key = _resolve_key(header, key, algorithm)
+    # signing input is 'header.' followed by the raw payload
+    return signing_input, header, key, _load_signature(crypto_segment)
+
+
+def _detached_header(key: HMACKey, headers=None) -> bytes:
+    if key.kid is not None:
+        headers = {"kid": key.kid, **headers} if headers else {"kid": key.kid}
+    if not headers:
+        return _cached_detached_header(key.algorithm, ())
+    try:
+        return _cached_detached_header(key.algorithm, tuple((k, type(v), v) for k, v in headers.items()))
+    except TypeError:
+        return _build_detached_header(key.algorithm, headers)
+
+
+@functools.lru_cache(maxsize=64)
+def _cached_detached_header(algorithm, header_items: tuple) -> bytes:
+    return _build_detached_header(algorithm, {k: v for k, _, v in header_items})
+
+
+def _build_detached_header(algorithm, additional_headers) -> bytes:
+    header = {"alg": algorithm, "b64": False, "crit": ["b64"]}
+    if additional_headers:
+        header.update(additional_headers)
+    return b64encode(orjson.dumps(header))
+
+
+def _detached_token(header_segment, signature) -> str:
+    return (header_segment + b".." + b64encode(signature)).decode("utf-8")
 
 
 def b64decode(content):
     rem = len(content) % 4
     if rem > 0:
-        content += b"=" * (4 - rem)
+        content = bytes(content) + b"=" * (4 - rem)
     return cryptutils.urlsafe_b64decode(content)
 
 
@@ -1,26 +1,41 @@
 __author__ = 'ziyan.yin'
 __describe__ = ''
 
+import asyncio
+import functools
+import itertools
+import time
 from calendar import timegm
 from datetime import datetime
-from typing import Mapping
+from typing import Mapping, Union, Iterable, Optional, List, Callable
 
 import orjson
 
 from . import jwk
+from .cache import TokenCache
 from .exceptions import JWTError, JWTClaimsError, ExpiredSignatureError
-from .jws import verify, sign, load, b64decode, b64encode
+from .jws import sign, load_verified, b64decode, b64encode, get_key
 
+BATCH_CHUNK_SIZE = 64
 
-def encode(claims: dict, key: str, algorithm='HS256', headers=None, access_token=None) -> str:
+
+def encode(
+    claims: dict,
+    key: Union[str, jwk.HMACKey, jwk.KeySet],
+    algorithm='HS256',
+    headers=None,
+    access_token=None
+) -> str:
     """
     JWTs are JWS signed objects with a few reserved claims.
 
     Args:
         claims (dict): A claims set to sign
-        key (str): The key to use for signing the claim set
+        key (str, HMACKey or KeySet): The key to use for signing the claim
+            set, a key prepared by `jwk.prepare_key` skips the per-call setup.
+            A KeySet signs with its newest active key and stamps its 'kid'.
         algorithm (str, optional): The algorithm to use for signing the
-            the claims.  Defaults to HS256.
+            the claims.  Defaults to HS256, ignored for a KeySet.
         headers (dict, optional): A set of headers that will be added to
             the default headers.  Any headers that are added as additional
             headers will override the default headers.
@@ -40,39 +55,232 @@ def encode(claims: dict, key: str, algorithm='HS256', headers=None, access_token
         'eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJhIjoiYiJ9.jiMyrsmD8AoHWeQgmxZ5yq8z0lXS67_QGs52AzC8Ru8'
 
     """
+    if isinstance(key, jwk.KeySet):
+        key = key.signing_key()
+        algorithm = key.algorithm
     if algorithm not in jwk.HASHES:
         raise JWTError("Algorithm %s not supported." % algorithm)
+    if isinstance(key, jwk.HMACKey) and key.kid is not None:
+        headers = {"kid": key.kid, **headers} if headers else {"kid": key.kid}
 
-    for time_claim in ("exp", "iat", "nbf"):
-        # Convert datetime to a intDate value in known time-format claims
-        if isinstance(claims.get(time_claim), datetime):
-            claims[time_claim] = timegm(claims[time_claim].utctimetuple())
-    if access_token:
-        claims["at_hash"] = _calculate_at_hash(access_token, jwk.HASHES[algorithm])
-
+    _prepare_claims(claims, algorithm, access_token)
     encoded_headers = _encode_header(algorithm, headers)
     encoded_payload = _encode_payload(claims)
     return _sign_header_and_payload(encoded_headers, encoded_payload, algorithm, key)
 
 
-def decode(token: str, key: str, algorithm, leeway=0, audience=None, issuer=None, subject=None, access_token=None):
-    header, payload, signing_input, signature = load(token)
-    verify(signing_input, signature, key, algorithm)
-    claims = orjson.loads(payload)
-    algorithm = header["alg"]
-
-    _validate_claims(
-        claims,
-        leeway,
-        audience=audience,
-        issuer=issuer,
-        subject=subject,
-        algorithm=algorithm,
-        access_token=access_token,
-    )
+def decode(
+    token: str,
+    key: Union[str, jwk.HMACKey, jwk.KeySet],
+    algorithm=None,
+    leeway=0,
+    audience=None,
+    issuer=None,
+    subject=None,
+    access_token=None,
+    cache: TokenCache = None,
+    validator: 'JWTValidator' = None,
+    jti_store=None
+):
+    """
+    Verifies a JWT string's signature and validates reserved claims.
+
+    Args:
+        token (str, bytes or memoryview): A signed JWS to be verified, the
+            header is checked before the signature and the payload is only
+            decoded once the signature is valid.
+        key (str, HMACKey or KeySet): A key to attempt to verify the payload
+            with, a KeySet picks the key named by the 'kid' header.
+        algorithm (str, optional): The algorithm the key is used with.
+            Defaults to the algorithm of a prepared key, or HS256.
+        leeway (int, optional): The number of seconds of skew that is allowed.
+        audience (str, optional): The intended audience of the token.
+        issuer (str or iterable, optional): Acceptable value(s) for the issuer.
+        subject (str, optional): The subject of the token.
+        access_token (str, optional): An access token to compare against 'at_hash'.
+        cache (TokenCache, optional): A cache of verified claims, a hit skips
+            decoding and signature checks but 'nbf' and 'exp' are always
+            checked against the clock.
+        validator (JWTValidator, optional): A prebuilt validator, replaces
+            leeway, audience, issuer and subject when given.
+        jti_store (JtiStore, optional): A seen-set of 'jti', the token is
+            rejected if it has no 'jti' or was decoded before. Any object
+            with a `claim(jti, exp)` method is accepted.
+
+    Returns:
+        dict: The dict representation of the claims set.
+
+    Raises:
+        JWTError: If the signature is invalid in any way.
+        ExpiredSignatureError: If the signature has expired.
+        JWTClaimsError: If any claim is invalid in any way.
+    """
+    claims = _decode_claims(token, key, algorithm, leeway, audience, issuer, subject, access_token, cache, validator)
+    if jti_store is not None:
+        _validate_replay(claims, jti_store)
+    return claims
+
+
+async def decode_async(
+    token: str,
+    key: Union[str, jwk.HMACKey, jwk.KeySet],
+    algorithm=None,
+    leeway=0,
+    audience=None,
+    issuer=None,
+    subject=None,
+    access_token=None,
+    cache: TokenCache = None,
+    validator: 'JWTValidator' = None,
+    jti_store=None
+):
+    """
+    async variant of `decode`, replay is checked by `await jti_store.claim_async(jti, exp)`
+    so stores with an async backend (e.g. `DatasourceJtiBackend`) can be used
+    """
+    claims = _decode_claims(token, key, algorithm, leeway, audience, issuer, subject, access_token, cache, validator)
+    if jti_store is not None:
+        _check_jti(claims)
+        if not await jti_store.claim_async(claims["jti"], claims.get("exp")):
+            raise JWTClaimsError("Token has already been used (jti).")
     return claims
 
 
+def _decode_claims(token, key, algorithm, leeway, audience, issuer, subject, access_token, cache, validator) -> dict:
+    if validator is None:
+        validator = _get_validator(leeway, _freeze(audience), _freeze(issuer), subject)
+
+    key_set = None
+    if isinstance(key, jwk.KeySet):
+        key_set = key
+    else:
+        key = _get_key(key, algorithm)
+
+    claims = None
+    if cache is not None:
+        token_key = token if isinstance(token, (str, bytes)) else bytes(token)
+        cache_key = (token_key, key, key_set.version if key_set else 0, validator, access_token)
+        claims = cache.get(cache_key, validator.leeway)
+
+    if claims is None:
+        header, payload, key = load_verified(token, key, algorithm)
+        claims = orjson.loads(payload)
+        algorithm = header["alg"]
+
+        validator.validate(claims, algorithm=algorithm, access_token=access_token)
+        if cache is not None:
+            cache.put(cache_key, claims, expires=key.expires)
+
+    return claims
+
+
+def encode_many(
+    claims_set: Iterable[dict],
+    key: Union[str, jwk.HMACKey, jwk.KeySet],
+    algorithm='HS256',
+    headers=None,
+    chunk_size: int = BATCH_CHUNK_SIZE
+) -> List[Union[str, Exception]]:
+    """
+    encode claims in chunks on worker threads
+
+    :param claims_set: claims to sign
+    :param key: the key to use for signing
+    :param algorithm: the algorithm to use for signing
+    :param headers: additional headers of every token
+    :param chunk_size: claims per worker task
+    :return: tokens in input order, an item that failed is replaced by its exception
+    """
+    key = _get_key(key, algorithm)
+    return _run_many(encode, claims_set, chunk_size, key=key, algorithm=algorithm, headers=headers)
+
+
+def decode_many(
+    tokens: Iterable[str],
+    key: Union[str, jwk.HMACKey, jwk.KeySet],
+    algorithm=None,
+    chunk_size: int = BATCH_CHUNK_SIZE,
+    **options
+) -> List[Union[dict, Exception]]:
+    """
+    decode tokens in chunks on worker threads
+
+    :param tokens: tokens to verify
+    :param key: the key to verify with
+    :param algorithm: the algorithm the key is used with
+    :param chunk_size: tokens per worker task
+    :param options: keyword arguments of `decode`
+    :return: claims in input order, an item that failed is replaced by its exception
+    """
+    key = _get_key(key, algorithm)
+    return _run_many(decode, tokens, chunk_size, key=key, algorithm=algorithm, **options)
+
+
+async def encode_many_async(
+    claims_set: Iterable[dict],
+    key: Union[str, jwk.HMACKey, jwk.KeySet],
+    algorithm='HS256',
+    headers=None,
+    chunk_size: int = BATCH_CHUNK_SIZE
+) -> List[Union[str, Exception]]:
+    """
+    async variant of `encode_many`, chunks run on the event loop's worker threads
+    """
+    key = _get_key(key, algorithm)
+    return await _run_many_async(encode, claims_set, chunk_size, key=key, algorithm=algorithm, headers=headers)
+
+
+async def decode_many_async(
+    tokens: Iterable[str],
+    key: Union[str, jwk.HMACKey, jwk.KeySet],
+    algorithm=None,
+    chunk_size: int = BATCH_CHUNK_SIZE,
+    **options
+) -> List[Union[dict, Exception]]:
+    """
+    async variant of `decode_many`, chunks run on the event loop's worker threads
+    """
+    key = _get_key(key, algorithm)
+    return await _run_many_async(decode, tokens, chunk_size, key=key, algorithm=algorithm, **options)
+
+
+def _get_key(key, algorithm) -> Union[jwk.HMACKey, jwk.KeySet]:
+    if isinstance(key, jwk.KeySet):
+        return key
+    if algorithm is None:
+        algorithm = key.algorithm if isinstance(key, jwk.HMACKey) else 'HS256'
+    return get_key(key, algorithm)
+
+
+def _chunks(items: Iterable, chunk_size: int):
+    iterator = iter(items)
+    while chunk := list(itertools.islice(iterator, max(chunk_size, 1))):
+        yield chunk
+
+
+def _run_chunk(func: Callable, chunk: list, kwargs: dict) -> list:
+    res = []
+    for item in chunk:
+        try:
+            res.append(func(item, **kwargs))
+        except Exception as ex:
+            res.append(ex)
+    return res
+
+
+def _run_many(func: Callable, items: Iterable, chunk_size: int, **kwargs) -> list:
+    # imported here since importing basex.core loads settings and patches fastapi
+    from ..core.background import submit_thread
+    futures = [submit_thread(_run_chunk, func, chunk, kwargs) for chunk in _chunks(items, chunk_size)]
+    return list(itertools.chain.from_iterable(future.result() for future in futures))
+
+
+async def _run_many_async(func: Callable, items: Iterable, chunk_size: int, **kwargs) -> list:
+    from ..core.background import call_async
+    results = await asyncio.gather(*(call_async(_run_chunk, func, chunk, kwargs) for chunk in _chunks(items, chunk_size)))
+    return list(itertools.chain.from_iterable(results))
+
+
 def _calculate_at_hash(access_token, hash_alg) -> str:
     """
     Args:
@@ -86,7 +294,32 @@ def _calculate_at_hash(access_token, hash_alg) -> str:
     return at_hash.decode("utf-8")
 
 
+def _prepare_claims(claims, algorithm, access_token=None):
+    for time_claim in ("exp", "iat", "nbf"):
+        # Convert datetime to a intDate value in known time-format claims
+        if isinstance(claims.get(time_claim), datetime):
+            claims[time_claim] = timegm(claims[time_claim].utctimetuple())
+    if access_token:
+        claims["at_hash"] = _calculate_at_hash(access_token, jwk.HASHES[algorithm])
+
+
 def _encode_header(algorithm, additional_headers=None) -> bytes:
+    if not additional_headers:
+        return _cached_header(algorithm, ())
+    try:
+        # typed so that values equal across types (1, 1.0, True) do not share a segment
+        return _cached_header(algorithm, tuple((k, type(v), v) for k, v in additional_headers.items()))
+    except TypeError:
+        # unhashable header values are encoded every time
+        return _build_header(algorithm, additional_headers)
+
+
+@functools.lru_cache(maxsize=256)
+def _cached_header(algorithm, header_items: tuple) -> bytes:
+    return _build_header(algorithm, {k: v for k, _, v in header_items})
+
+
+def _build_header(algorithm, additional_headers) -> bytes:
     header = {"typ": "JWT", "alg": algorithm}
     if additional_headers:
         header.update(additional_headers)
@@ -110,160 +343,222 @@ def _sign_header_and_payload(encoded_header, encoded_payload, algorithm, key) ->
     return (b".".join([encoded_header, encoded_payload, encoded_signature])).decode('utf-8')
 
 
-def _validate_claims(
-    claims, leeway=0, audience=None, issuer=None, subject=None, algorithm=None, access_token=None
-):
-    if not isinstance(audience, ((str,), type(None))):
-        raise JWTError("audience must be a string or None")
+class TokenIssuer:
+    """
+        token issuer with a prepared key and encoded header, only claims are serialized per token
 
-    _validate_iat(claims)
-    _validate_nbf(claims, leeway=leeway)
-    _validate_exp(claims, leeway=leeway)
+            >>> issuer = TokenIssuer('secret', 'HS256', headers={'kid': 'a'})
+            >>> token = issuer.issue({'sub': 'user', 'exp': 1700000000})
+    """
+    __slots__ = ('key', 'algorithm', 'header', '_prefix', '_hmac')
+
+    def __init__(self, key: Union[str, jwk.HMACKey], algorithm='HS256', headers=None):
+        if algorithm not in jwk.HASHES:
+            raise JWTError("Algorithm %s not supported." % algorithm)
+        self.key = get_key(key, algorithm)
+        self.algorithm = algorithm
+        if self.key.kid is not None:
+            headers = {"kid": self.key.kid, **headers} if headers else {"kid": self.key.kid}
+        self.header = _encode_header(algorithm, headers)
+        self._prefix = self.header + b'.'
+        self._hmac = self.key.new(self._prefix)
+
+    def issue(self, claims: dict, access_token=None) -> str:
+        _prepare_claims(claims, self.algorithm, access_token)
+        encoded_payload = _encode_payload(claims)
+        h = self._hmac.copy()
+        h.update(encoded_payload)
+        return (self._prefix + encoded_payload + b'.' + b64encode(h.digest())).decode('utf-8')
+
+
+class JWTValidator:
+    """
+        claims validator built once, runs a fixed list of checks on every token
 
-    if audience:
-        _validate_aud(claims, audience=audience)
+            >>> validator = JWTValidator(audience='api', issuer=('a', 'b'), leeway=10, require=('exp',))
+            >>> claims = jwt.decode(token, key, 'HS256', validator=validator)
+    """
+    __slots__ = ('leeway', 'audience', 'issuer', 'subject', 'require', '_checks')
+
+    def __init__(
+        self,
+        audience: Union[str, Iterable[str], None] = None,
+        issuer: Union[str, Iterable[str], None] = None,
+        subject: Optional[str] = None,
+        leeway: int = 0,
+        require: Iterable[str] = ()
+    ):
+        self.leeway = int(leeway)
+        self.audience = _to_set(audience, 'audience')
+        self.issuer = _to_set(issuer, 'issuer')
+        self.subject = subject
+        self.require = tuple(require)
+
+        checks = []
+        if self.require:
+            checks.append(self._validate_required)
+        checks.extend((_validate_iat, self._validate_nbf, self._validate_exp))
+        if self.audience:
+            checks.append(self._validate_aud)
+        if self.issuer:
+            checks.append(self._validate_iss)
+        checks.extend((self._validate_sub, _validate_jti))
+        self._checks = tuple(checks)
+
+    def validate(self, claims: Mapping, algorithm: str = None, access_token: str = None, now: int = None):
+        """
+        Args:
+            claims (dict): The claims dictionary to validate.
+            algorithm (str): The algorithm used to sign the JWT.
+            access_token (str): The access token returned by the OpenID Provider.
+            now (int): Current unix time, read from the clock if not given.
+        """
+        if now is None:
+            now = int(time.time())
+        for check in self._checks:
+            check(claims, now)
+        if access_token:
+            _validate_at_hash(claims, access_token, algorithm)
+
+    def _validate_required(self, claims, now):
+        for claim in self.require:
+            if claim not in claims:
+                raise JWTClaimsError("Token is missing the '%s' claim." % claim)
+
+    def _validate_nbf(self, claims, now):
+        """
+        Validates that the 'nbf' claim is valid.
+        """
+        if "nbf" not in claims:
+            return
 
-    if issuer:
-        _validate_iss(claims, issuer=issuer)
+        try:
+            nbf = int(claims["nbf"])
+        except ValueError:
+            raise JWTClaimsError("Not Before claim (nbf) must be an integer.")
 
-    if subject:
-        _validate_sub(claims, subject=subject)
+        if nbf > (now + self.leeway):
+            raise JWTClaimsError("The token is not yet valid (nbf)")
 
-    _validate_jti(claims)
+    def _validate_exp(self, claims, now):
+        """
+        Validates that the 'exp' claim is valid.
+        """
+        if "exp" not in claims:
+            return
 
-    if access_token:
-        _validate_at_hash(claims, access_token, algorithm)
+        try:
+            exp = int(claims["exp"])
+        except ValueError:
+            raise JWTClaimsError("Expiration Time claim (exp) must be an integer.")
 
+        if exp < (now - self.leeway):
+            raise ExpiredSignatureError("Signature has expired.")
 
-def _validate_iat(claims):
-    """
-    Validates that the 'iat' claim is valid.
-    Args:
-        claims (dict): The claims dictionary to validate.
-    """
+    def _validate_aud(self, claims, now):
+        """
+        Validates that the 'aud' claim is valid.
+        """
+        if "aud" not in claims:
+            raise JWTError('Audience claim expected, but not in claims')
 
-    if "iat" not in claims:
-        return
+        audience_claims = claims["aud"]
+        if isinstance(audience_claims, str):
+            audience_claims = (audience_claims,)
+        elif not isinstance(audience_claims, list) or any(not isinstance(c, str) for c in audience_claims):
+            raise JWTClaimsError("Invalid claim format in token")
+        if self.audience.isdisjoint(audience_claims):
+            raise JWTClaimsError("Invalid audience")
+
+    def _validate_iss(self, claims, now):
+        """
+        Validates that the 'iss' claim is valid.
+        """
+        if claims.get("iss") not in self.issuer:
+            raise JWTClaimsError("Invalid issuer")
 
-    try:
-        int(claims["iat"])
-    except ValueError:
-        raise JWTClaimsError("Issued At claim (iat) must be an integer.")
+    def _validate_sub(self, claims, now):
+        """
+        Validates that the 'sub' claim is valid.
+        """
+        if "sub" not in claims:
+            return
 
+        if not isinstance(claims["sub"], str):
+            raise JWTClaimsError("Subject must be a string.")
 
-def _validate_nbf(claims, leeway=0):
-    """
-    Validates that the 'nbf' claim is valid.
-    Args:
-        claims (dict): The claims dictionary to validate.
-        leeway (int): The number of seconds of skew that is allowed.
-    """
+        if self.subject is not None and claims["sub"] != self.subject:
+            raise JWTClaimsError("Invalid subject")
 
-    if "nbf" not in claims:
-        return
 
-    try:
-        nbf = int(claims["nbf"])
-    except ValueError:
-        raise JWTClaimsError("Not Before claim (nbf) must be an integer.")
+@functools.lru_cache(maxsize=64)
+def _get_validator(leeway, audience, issuer, subject) -> JWTValidator:
+    return JWTValidator(audience=audience, issuer=issuer, subject=subject, leeway=leeway)
+
 
-    now = timegm(datetime.utcnow().utctimetuple())
+def _freeze(value):
+    if value is None or isinstance(value, str):
+        return value
+    return frozenset(value)
 
-    if nbf > (now + leeway):
-        raise JWTClaimsError("The token is not yet valid (nbf)")
 
+def _to_set(value, name) -> Optional[frozenset]:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return frozenset((value,))
+    value = frozenset(value)
+    if any(not isinstance(x, str) for x in value):
+        raise JWTError("%s must be a string, an iterable of strings or None" % name)
+    return value
 
-def _validate_exp(claims, leeway=0):
+
+def _validate_iat(claims, now):
     """
-    Validates that the 'exp' claim is valid.
+    Validates that the 'iat' claim is valid.
     Args:
         claims (dict): The claims dictionary to validate.
-        leeway (int): The number of seconds of skew that is allowed.
+        now (int): Current unix time.
     """
 
-    if "exp" not in claims:
+    if "iat" not in claims:
         return
 
     try:
-        exp = int(claims["exp"])
+        int(claims["iat"])
     except ValueError:
-        raise JWTClaimsError("Expiration Time claim (exp) must be an integer.")
-
-    now = timegm(datetime.utcnow().utctimetuple())
-
-    if exp < (now - leeway):
-        raise ExpiredSignatureError("Signature has expired.")
+        raise JWTClaimsError("Issued At claim (iat) must be an integer.")
 
 
-def _validate_aud(claims, audience=None):
+def _validate_jti(claims, now):
     """
-    Validates that the 'aud' claim is valid.
+    Validates that the 'jti' claim is valid.
     Args:
         claims (dict): The claims dictionary to validate.
-        audience (str): The audience that is verifying the token.
+        now (int): Current unix time.
     """
-
-    if "aud" not in claims:
-        if audience:
-            raise JWTError('Audience claim expected, but not in claims')
+    if "jti" not in claims:
         return
 
-    audience_claims = claims["aud"]
-    if isinstance(audience_claims, str):
-        audience_claims = [audience_claims]
-    if not isinstance(audience_claims, list):
-        raise JWTClaimsError("Invalid claim format in token")
-    if any(not isinstance(c, str) for c in audience_claims):
-        raise JWTClaimsError("Invalid claim format in token")
-    if audience not in audience_claims:
-        raise JWTClaimsError("Invalid audience")
-
-
-def _validate_iss(claims, issuer=None):
-    """
-    Validates that the 'iss' claim is valid.
-    Args:
-        claims (dict): The claims dictionary to validate.
-        issuer (str or iterable): Acceptable value(s) for the issuer that
-                                  signed the token.
-    """
-
-    if issuer is not None:
-        if isinstance(issuer, str):
-            issuer = (issuer,)
-        if claims.get("iss") not in issuer:
-            raise JWTClaimsError("Invalid issuer")
+    if not isinstance(claims["jti"], str):
+        raise JWTClaimsError("JWT ID must be a string.")
 
 
-def _validate_sub(claims, subject=None):
+def _validate_replay(claims, jti_store):
     """
-    Validates that the 'sub' claim is valid.
+    Validates that the 'jti' claim is present and has not been used before.
     Args:
         claims (dict): The claims dictionary to validate.
-        subject (str): The subject of the token.
+        jti_store (JtiStore): The seen-set of used 'jti'.
     """
+    _check_jti(claims)
+    if not jti_store.claim(claims["jti"], claims.get("exp")):
+        raise JWTClaimsError("Token has already been used (jti).")
 
-    if "sub" not in claims:
-        return
 
-    if not isinstance(claims["sub"], str):
-        raise JWTClaimsError("Subject must be a string.")
-
-    if subject is not None and claims.get("sub") != subject:
-        raise JWTClaimsError("Invalid subject")
-
-
-def _validate_jti(claims):
-    """
-    Validates that the 'jti' claim is valid.
-    Args:
-        claims (dict): The claims dictionary to validate.
-    """
+def _check_jti(claims):
     if "jti" not in claims:
-        return
-
-    if not isinstance(claims["jti"], str):
-        raise JWTClaimsError("JWT ID must be a string.")
+        raise JWTClaimsError("Token is missing the 'jti' claim.")
 
 
 def _validate_at_hash(claims, access_token, algorithm):
@@ -0,0 +1,192 @@
+__author__ = 'ziyan.yin'
+__describe__ = 'jti replay protection'
+
+import hashlib
+import heapq
+import math
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from typing import Optional, Dict, List, Tuple
+
+StoreInfo = namedtuple('StoreInfo', ['lookups', 'bloom_misses', 'replays', 'rejects', 'backend_calls', 'size', 'avg_ns'])
+
+class BloomFilter:
+    """
+        bloom filter over str items, k positions come from one blake2b digest by double hashing
+    """
+    __slots__ = ('capacity', 'size', 'hashes', 'count', '_bits')
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class JtiBackend:
+    """
+        shared storage of used jti for multi-process deployments
+    """
+
+    def claim(self, jti: str, exp: int) -> bool:
+        """
+        :return: True if jti is unused or its previous use has expired
+        """
+        raise NotImplementedError
+
+    async def claim_async(self, jti: str, exp: int) -> bool:
+        return self.claim(jti, exp)
+
+
+class SqliteJtiBackend(JtiBackend):
+    """
+        used jti in a sqlite file, shared by the processes of one host
+    """
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS used_jti (jti TEXT PRIMARY KEY, exp INTEGER NOT NULL)')
+
+    def claim(self, jti: str, exp: int) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO used_jti (jti, exp) VALUES (?, ?) '
+                'ON CONFLICT(jti) DO UPDATE SET exp = excluded.exp WHERE used_jti.exp < ?',
+                (jti, exp, int(time.time()))
+            )
+            return cursor.rowcount == 1
+
+    def purge(self) -> int:
+        with self._lock:
+            return self._conn.execute('DELETE FROM used_jti WHERE exp < ?', (int(time.time()),)).rowcount
+
+    def close(self):
+        self._conn.close()
+
+
+class JtiStore:
+    """
+        seen-set of jti, a bloom filter in front of an exact set whose entries live until the token's 'exp'
+
+            >>> store = JtiStore(capacity=100000)
+            >>> claims = jwt.decode(token, key, jti_store=store)
+    """
+
+    def __init__(
+        self,
+        capacity: int = 100000,
+        error_rate: float = 0.001,
+        default_ttl: int = 3600,
+        backend: Optional[JtiBackend] = None
+    ):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.default_ttl = default_ttl
+        self.backend = backend
+        self.lookups = 0
+        self.bloom_misses = 0
+        self.replays = 0
+        self.rejects = 0
+        self.backend_calls = 0
+        self.elapsed_ns = 0
+        self._bloom = BloomFilter(capacity * 2, error_rate)
+        self._seen: Dict[str, int] = {}
+        self._expiry: List[Tuple[int, str]] = []
+        self._lock = threading.Lock()
+
+    def claim(self, jti: str, exp: Optional[int] = None) -> bool:
+        """
+        mark jti as used
+
+        :param jti: token id
+        :param exp: token expiry, jti is remembered until then
+        :return: False if jti was already used or the store is full of live jti
+        """
+        start = time.perf_counter_ns()
+        now = int(time.time())
+        exp = int(exp) if exp is not None else now + self.default_ttl
+        try:
+            if not self._claim_local(jti, exp, now):
+                return False
+            if self.backend is not None:
+                self.backend_calls += 1
+                if not self.backend.claim(jti, exp):
+                    self.replays += 1
+                    return False
+            return True
+        finally:
+            self.elapsed_ns += time.perf_counter_ns() - start
+
+    async def claim_async(self, jti: str, exp: Optional[int] = None) -> bool:
+        start = time.perf_counter_ns()
+        now = int(time.time())
+        exp = int(exp) if exp is not None else now + self.default_ttl
+        if not self._claim_local(jti, exp, now):
+            self.elapsed_ns += time.perf_counter_ns() - start
+            return False
+        self.elapsed_ns += time.perf_counter_ns() - start
+        if self.backend is not None:
+            self.backend_calls += 1
+            if not await self.backend.claim_async(jti, exp):
+                self.replays += 1
+                return False
+        return True
+
+    def _claim_local(self, jti: str, exp: int, now: int) -> bool:
+        with self._lock:
+            self.lookups += 1
+            self._expire(now)
+            if jti not in self._bloom:
+                self.bloom_misses += 1
+            elif (seen := self._seen.get(jti)) is not None and seen >= now:
+                self.replays += 1
+                return False
+            if len(self._seen) >= self.capacity:
+                # full of live tokens, forgetting one would let it be replayed
+                self.rejects += 1
+                return False
+            self._seen[jti] = exp
+            heapq.heappush(self._expiry, (exp, jti))
+            if self._bloom.count >= self._bloom.capacity:
+                self._rebuild()
+            else:
+                self._bloom.add(jti)
+            return True
+
+    def _expire(self, now: int):
+        expiry = self._expiry
+        while expiry and expiry[0][0] < now:
+            exp, jti = heapq.heappop(expiry)
+            if self._seen.get(jti) == exp:
+                del self._seen[jti]
+
+    def _rebuild(self):
+        self._bloom = BloomFilter(self.capacity * 2, self.error_rate)
+        for jti in self._seen:
+            self._bloom.add(jti)
+
+    def info(self) -> StoreInfo:
+        avg_ns = self.elapsed_ns // self.lookups if self.lookups else 0
+        return StoreInfo(
+            self.lookups, self.bloom_misses, self.replays, self.rejects, self.backend_calls, len(self._seen), avg_ns
+        )
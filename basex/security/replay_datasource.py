@@ -0,0 +1,45 @@
+__author__ = 'ziyan.yin'
+__describe__ = 'jti replay protection by datasource'
+
+import time
+
+from sqlalchemy import Table, Column, MetaData, String, BigInteger, update
+from sqlalchemy.exc import IntegrityError
+
+from .replay import JtiBackend
+from ..core.service import SessionService
+
+metadata = MetaData()
+used_jti = Table(
+    'used_jti',
+    metadata,
+    Column('jti', String(255), primary_key=True),
+    Column('exp', BigInteger(), nullable=False),
+)
+
+
+class DatasourceJtiBackend(JtiBackend, SessionService):
+    """
+        used jti in table 'used_jti' of a configured datasource,
+        only usable with `JtiStore.claim_async` or `jwt.decode_async`
+    """
+
+    def __init__(self, datasource: str = 'default'):
+        self._datasource = datasource
+
+    @property
+    def datasource(self) -> str:
+        return self._datasource
+
+    def claim(self, jti: str, exp: int) -> bool:
+        raise NotImplementedError('datasource backend is async, use JtiStore.claim_async or jwt.decode_async')
+
+    async def claim_async(self, jti: str, exp: int) -> bool:
+        try:
+            await self.execute(used_jti.insert().values(jti=jti, exp=exp))
+            return True
+        except IntegrityError:
+            res = await self.execute(
+                update(used_jti).where(used_jti.c.jti == jti, used_jti.c.exp < int(time.time())).values(exp=exp)
+            )
+            return res.rowcount == 1
@@ -0,0 +1,187 @@
+__author__ = 'ziyan.yin'
+__describe__ = 'jwt/jws micro benchmark'
+
+import argparse
+import gc
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+import orjson
+
+from basex.security import jwt, jws, jwk
+
+ALGORITHMS = ('HS256', 'HS384', 'HS512')
+CLAIM_SIZES = {
+    'tiny': 0,
+    '1k': 1 << 10,
+    '16k': 1 << 14,
+    '64k': 1 << 16,
+}
+SECRET = 'benchmark-secret'
+USAGE = """
+    python -m benchmarks.bench_security --output bench.json
+    python -m benchmarks.bench_security --baseline bench.json --threshold 0.1
+
+exit code is 1 when any case is slower than baseline by more than threshold
+"""
+
+
+def make_claims(size: int) -> dict:
+    claims = {'sub': 'benchmark', 'exp': int(time.time()) + 3600}
+    if size:
+        claims['data'] = 'x' * size
+    return claims
+
+
+def measure(func: Callable[[], object], min_time: float) -> Tuple[float, int, float]:
+    """
+    :return: ops per second, peak bytes allocated by one call, retained blocks per call
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10 or number >= 1 << 24:
+            break
+        number *= 10
+
+    gc.disable()
+    try:
+        rounds = max(int(number * min_time / max(elapsed, 1e-9)), 1)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            func()
+        ops = rounds / (time.perf_counter() - start)
+    finally:
+        gc.enable()
+
+    tracemalloc.start()
+    try:
+        func()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        current, _ = tracemalloc.get_traced_memory()
+        for _ in range(100):
+            func()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return ops, max(peak - current, 0), blocks / 100
+
+
+def _raises(func: Callable[[], object]) -> Callable[[], object]:
+    def wrapper():
+        try:
+            func()
+        except jwt.JWTError:
+            return
+        raise AssertionError('case is expected to fail')
+    return wrapper
+
+
+def build_cases() -> Dict[str, Callable[[], object]]:
+    cases = {}
+    for alg in ALGORITHMS:
+        key = jwk.prepare_key(SECRET, alg)
+        cases['hmac.sign.%s' % alg] = lambda k=key: k.sign(b'header.payload')
+        for name, size in CLAIM_SIZES.items():
+            claims = make_claims(size)
+            token = jwt.encode(dict(claims), key, alg)
+            expired = jwt.encode(dict(claims, exp=1), key, alg)
+            header, payload, signature = token.split('.')
+            bad_signature = '.'.join((header, payload, signature[::-1]))
+            bad_header = '.'.join(('e30', payload, signature))
+            suffix = '%s.%s' % (alg, name)
+
+            cases['jwt.encode.' + suffix] = lambda c=claims, k=key, a=alg: jwt.encode(dict(c), k, a)
+            cases['jwt.encode.raw_key.' + suffix] = lambda c=claims, a=alg: jwt.encode(dict(c), SECRET, a)
+            cases['jwt.decode.valid.' + suffix] = lambda t=token, k=key: jwt.decode(t, k)
+            cases['jwt.decode.expired.' + suffix] = _raises(lambda t=expired, k=key: jwt.decode(t, k))
+            cases['jwt.decode.bad_signature.' + suffix] = _raises(lambda t=bad_signature, k=key: jwt.decode(t, k))
+            cases['jwt.decode.bad_header.' + suffix] = _raises(lambda t=bad_header, k=key: jwt.decode(t, k))
+            cases['jws.load.' + suffix] = lambda t=token: jws.load(t)
+
+    for name, size in CLAIM_SIZES.items():
+        raw = orjson.dumps(make_claims(size))
+        encoded = jws.b64encode(raw)
+        cases['b64encode.' + name] = lambda r=raw: jws.b64encode(r)
+        cases['b64decode.' + name] = lambda e=encoded: jws.b64decode(e)
+    return cases
+
+
+def run(patterns: List[str], min_time: float) -> Dict[str, dict]:
+    results = {}
+    for name, func in build_cases().items():
+        if patterns and not any(pattern in name for pattern in patterns):
+            continue
+        ops, alloc_bytes, alloc_blocks = measure(func, min_time)
+        results[name] = {
+            'ops': round(ops, 1),
+            'ns_per_op': round(1e9 / ops, 1),
+            'alloc_bytes': alloc_bytes,
+            'alloc_blocks': alloc_blocks,
+        }
+        print('%-48s %14.1f ops/s %10.1f ns %10d B %8.2f blk' % (
+            name, ops, 1e9 / ops, alloc_bytes, alloc_blocks
+        ))
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    regressions = []
+    for name, current in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]['ops']
+        change = current['ops'] / expected - 1
+        if change < -threshold:
+            regressions.append(name)
+        print('%-48s %14.1f -> %14.1f ops/s %+8.1f%%%s' % (
+            name, expected, current['ops'], change * 100, '  REGRESSION' if change < -threshold else ''
+        ))
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='basex.security micro benchmark',
+        epilog=USAGE,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('-k', '--filter', action='append', default=[], help='only run cases containing this text')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds spent on each case')
+    parser.add_argument('--output', help='save results as json')
+    parser.add_argument('--baseline', help='json results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed slowdown against baseline')
+    args = parser.parse_args(argv)
+
+    results = run(args.filter, args.min_time)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(orjson.dumps({
+                'meta': {
+                    'python': sys.version,
+                    'platform': platform.platform(),
+                    'time': int(time.time()),
+                },
+                'results': results,
+            }, option=orjson.OPT_INDENT_2))
+
+    if args.baseline:
+        with open(args.baseline, 'rb') as f:
+            baseline = orjson.loads(f.read())['results']
+        if regressions := compare(results, baseline, args.threshold):
+            print('%d case(s) regressed more than %.0f%%' % (len(regressions), args.threshold * 100))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())